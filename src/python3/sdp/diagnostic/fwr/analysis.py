@@ -80,7 +80,7 @@ def Coherent_Signal(sig):
     M = sig
     M_bar = np.average(M)
 
-    M2_bar = np.average(M*np.conj(M))
+    M2_bar = np.vdot(M,M).real/np.size(M)
 
     return M_bar/np.sqrt(M2_bar)
 
@@ -118,9 +118,12 @@ def Cross_Correlation(sig1,sig2,mode='None'):
         pass
     
         
-    sig1_2_bar = np.average(sig1 * np.conj(sig1))
-    sig2_2_bar = np.average(sig2 * np.conj(sig2))
-    cross_bar = np.average(sig1 * np.conj(sig2))
+    # np.vdot(a,b) is the sum of conj(a)*b over the whole array, no product 
+    # array is created. |sig|^2 averages are real.
+    N = np.size(sig1)
+    sig1_2_bar = np.vdot(sig1,sig1).real/N
+    sig2_2_bar = np.vdot(sig2,sig2).real/N
+    cross_bar = np.vdot(sig2,sig1)/N
 
     r = cross_bar / np.sqrt(sig1_2_bar * sig2_2_bar)       
     
@@ -161,8 +164,8 @@ def Cross_Correlation_by_fft(sig1,sig2,mode = 'None'):
     
     f1 = np.fft.fft(sig1)
     f2 = np.fft.fft(sig2)
-    norm1 = np.sqrt(np.sum(sig1*np.conj(sig1)))
-    norm2 = np.sqrt(np.sum(sig2 * np.conj(sig2)))
+    norm1 = np.sqrt(np.vdot(sig1,sig1).real)
+    norm2 = np.sqrt(np.vdot(sig2,sig2).real)
     
     cross_f = np.conj(f1) * f2
     gamma_f = cross_f / (norm1 * norm2)
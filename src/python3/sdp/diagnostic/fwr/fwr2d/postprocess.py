@@ -10,6 +10,7 @@ Advanced Postprocesses:
     Frequency spectrum analysis,
 """
 from os import path
+import multiprocessing as mp
 
 import numpy as np
 import scipy.io.netcdf as nc
@@ -19,6 +20,123 @@ from scipy.interpolate import interp2d
 from ....io import code5 as c5
 
 
+def _trapz_weights(x):
+    """weights w of the trapezoidal rule on sample points x, such that 
+    np.sum(w*f) equals np.trapz(f, x=x)
+    """
+    dx = np.diff(x)
+    w = np.zeros(len(x))
+    w[:-1] += dx/2
+    w[1:] += dx/2
+    return w
+
+
+def _get_receiver(rec_file, receivers):
+    """return the Code5 reader of the receiver file. 
+    
+    The receiver files in the run directories are usually links to the 
+    same pattern file, so each pattern file is read only once, and kept 
+    under its real path in the dict receivers.
+    """
+    key = path.realpath(rec_file)
+    receiver = receivers.get(key)
+    if receiver is None:
+        receiver = c5.C5_reader(rec_file)
+        receivers[key] = receiver
+    return receiver
+
+
+def _read_E_out(ref_file, rec_file, dimension, receivers):
+    """read data from the output file, produce the received E signal
+    
+    receivers: dict of the receiver patterns already read, see 
+    :py:func:`_get_receiver`
+    return: (E_out, E_ref, E_rec), E_out is the complex received signal. 
+    For 3D output, E_ref and E_rec are the reflected and receiver fields on 
+    the integration grid, otherwise they are None.
+    """
+    #print 'reading file:',file
+    f = nc.netcdf_file(ref_file,'r')
+    #print 'finish reading.'
+
+    if(dimension == 2):
+        # only the central z row of the output is used, read only the 
+        # needed parts of the variables
+        y = np.copy(f.variables['a_y'].data)
+        z_idx = f.dimensions['a_nz']//2 -1
+        z_c = float(f.variables['a_z'][z_idx])
+        
+        # FWR2D output doesn't include the central ray WKB phase advance in
+        # paraxial region. The complete result needs to take into account 
+        # this additional phase
+        ephi_wkb_0 = f.variables['p_phaser'][0] + \
+                     1j * f.variables['p_phasei'][0]
+        ephi_wkb_1 = f.variables['p_phaser'][-1] + \
+                     1j * f.variables['p_phasei'][-1]
+        D_ephi = ephi_wkb_0/ephi_wkb_1
+        E_ref = np.copy(f.variables['a_Er'][1,z_idx,:] + \
+                        1j*f.variables['a_Ei'][1,z_idx,:])*D_ephi**2
+        f.close()
+
+        receiver = _get_receiver(rec_file, receivers)
+
+        # receiver field is also needed only on the central z row
+        E_rec = receiver.E_re_interp(z_c,y)[0] + \
+                1j* receiver.E_im_interp(z_c,y)[0]
+        
+        # trapezoidal integral of E_ref*conj(E_rec) over y, vdot does the
+        # conjugation and the sum in one call
+        E_out = np.vdot(E_rec, _trapz_weights(y)*E_ref)
+        return E_out, None, None
+        
+    elif(dimension == 3):
+        y = np.copy(f.variables['a_y'][:])
+        z = np.copy(f.variables['a_z'][:])
+        
+        receiver = _get_receiver(rec_file, receivers)
+        
+        #use area average to estimate E_ref*np.conj(E_receive) integrated over y,z dimension.
+        ymin = np.max([y[0], receiver.X1D[0]])
+        ymax = np.min([y[-1], receiver.X1D[-1]])
+        zmin = np.max([z[0], receiver.Y1D[0]])
+        zmax = np.min([z[-1], receiver.Y1D[-1]])
+        if (ymin >= ymax) or (zmin >= zmax):
+            # reflected wave and receiver pattern don't overlap, nothing 
+            # is received. Skip the interpolations.
+            f.close()
+            return 0, None, None
+        
+        E_ref_re_interp = interp2d(y,z,f.variables['a_Er'][1,:,:],
+                                   kind='cubic', fill_value=0)
+        E_ref_im_interp = interp2d(y,z,f.variables['a_Ei'][1,:,:],
+                                   kind='cubic', fill_value=0)            
+        f.close()
+
+        y_fine = np.linspace(ymin, ymax, 200)
+        z_fine = np.linspace(zmin, zmax, 200)
+        E_ref = E_ref_re_interp(y_fine, z_fine)+ \
+                1j*E_ref_im_interp(y_fine, z_fine)
+        E_rec = receiver.E_re_interp(z_fine,y_fine)+ \
+                1j*receiver.E_im_interp(z_fine,y_fine)
+        
+        # trapezoidal integral over z and y, done as one weighted vdot 
+        # like in the 2D case
+        w = np.outer(_trapz_weights(z_fine), _trapz_weights(y_fine))
+        E_out = np.vdot(E_rec, w*E_ref)
+        return E_out, E_ref, E_rec
+
+
+# receiver patterns read in this process by _read_E_out_in_worker, kept for 
+# all the later files the same worker process reads
+_worker_receivers = {}
+
+def _read_E_out_in_worker(ref_file, rec_file, dimension):
+    """received signal of one output file, to be called in a pool of 
+    processes, see :py:meth:`Reflectometer_Output.create_received_signals`
+    """
+    return _read_E_out(ref_file, rec_file, dimension, _worker_receivers)[0]
+
+
 class Reflectometer_Output:
     """Class that deal with the raw output from synthetic reflectometry 
     code(FWR2D / FWR3D)
@@ -40,10 +158,14 @@ class Reflectometer_Output:
                                       FWR_Driver script, this is the receiver 
                                       field pattern link name in every single 
                                       run dir created by FWR_Driver.
+    :param bool multiprocessing: Optional, default is False. If True, the 
+                                 output files are read in a pool of 
+                                 processes.
     """
 
     
-    def __init__(self,file_path,f_arr,t_arr,n_cross_section, FWR_dimension = 2,full_load = True,receiver_file_name='receiver_pattern.txt'):
+    def __init__(self,file_path,f_arr,t_arr,n_cross_section, FWR_dimension = 2,full_load = True,receiver_file_name='receiver_pattern.txt',
+                 multiprocessing = False):
         """initialize the output object, read the output files in file_path 
         specified by frequencies and timesteps.
         
@@ -56,6 +178,9 @@ class Reflectometer_Output:
         self.n_cross_section = n_cross_section
         self.receiver_file_name = receiver_file_name
         self.dimension = FWR_dimension
+        self.multiprocessing = multiprocessing
+        # receiver patterns already read, see get_receiver
+        self._receivers = {}
         if (full_load):
             self.create_received_signals()
         else:
@@ -66,23 +191,41 @@ somewhere else.')
     def create_received_signals(self):
         """This method actually recursively read all the needed output files 
         and produce the recieved signal for each file.
+        
+        The files of different frequencies, time steps and cross-sections are 
+        independent, if self.multiprocessing is True, they are read in a pool 
+        of processes. In that case, the receiver patterns are cached in the 
+        worker processes only, and for 3D output the fields of the last file,
+        self.E_ref and self.E_rec, are not available; they are set to None.
         """
-        self.E_out = np.zeros((self.NF,self.NT,self.n_cross_section))
-        self.E_out = self.E_out + 1j * self.E_out
-
-        for f_idx in range(self.NF):
-            for t_idx in range(self.NT):
-                for i in range(self.n_cross_section):
-                    fwr_file = self.make_file_name(self.frequencies[f_idx],
-                                                   self.timesteps[t_idx], i)
-                    receiver_file = \
-                    self.make_receiver_file_name(self.frequencies[f_idx],
-                                                 self.timesteps[t_idx], i, 
-                                                 self.receiver_file_name)
-                                                 
-                    self.E_out[f_idx,t_idx,i] = self.read_E_out(fwr_file,
-                                                                receiver_file)
-            print(('frequency '+str(self.frequencies[f_idx])+' read.'))
+        files = [(self.make_file_name(f, t, i), 
+                  self.make_receiver_file_name(f, t, i, 
+                                               self.receiver_file_name))
+                 for f in self.frequencies
+                 for t in self.timesteps 
+                 for i in range(self.n_cross_section)]
+
+        if self.multiprocessing:
+            # all the files are shared out in one go, several files per task,
+            # each worker process keeps the receiver patterns it has read
+            n_proc = mp.cpu_count()
+            chunksize = max(1, len(files)//(4*n_proc))
+            with mp.Pool(n_proc) as pool:
+                E_out = pool.starmap(_read_E_out_in_worker, 
+                                     [(ref_file, rec_file, self.dimension) 
+                                      for ref_file, rec_file in files], 
+                                     chunksize)
+            if(self.dimension == 3):
+                self.E_ref = None
+                self.E_rec = None
+        else:
+            E_out = [self.read_E_out(ref_file, rec_file) 
+                     for ref_file, rec_file in files]
+            
+        self.E_out = np.reshape(np.array(E_out, dtype=np.complex128),
+                                (self.NF, self.NT, self.n_cross_section))
+            
+        print(('{0} frequencies read.'.format(self.NF)))
                 
         return 0
     
@@ -110,70 +253,29 @@ somewhere else.')
         return path.join(full_path, file_name)
     
 
+    def get_receiver(self, rec_file):
+        """return the Code5 reader of the receiver file, see 
+        :py:func:`_get_receiver`.
+        """
+        return _get_receiver(rec_file, self._receivers)
+    
+
     def read_E_out(self, ref_file, rec_file):
         """read data from the output file, produce the received E signal, 
         return the complex E
+        
+        For 3D output, the reflected and receiver fields on the integration
+        grid are kept in self.E_ref and self.E_rec, they are None if the two
+        fields don't overlap. The receiver patterns read are cached in 
+        self._receivers. Both are only done in the calling process, see 
+        :py:meth:`create_received_signals` for the multiprocessing case.
         """
-        #print 'reading file:',file
-        f = nc.netcdf_file(ref_file,'r')
-        #print 'finish reading.'
-
-        if(self.dimension == 2):
-            y = np.copy(f.variables['a_y'].data)
-            z = np.copy(f.variables['a_z'].data)
-            z_idx = f.dimensions['a_nz']/2 -1
-            
-            # FWR2D output doesn't include the central ray WKB phase advance in
-            # paraxial region. The complete result needs to take into account 
-            # this additional phase
-            ephi_wkb = f.variables['p_phaser'][...] +\
-                       1j * f.variables['p_phasei'][...]
-            D_ephi = ephi_wkb[0]/ephi_wkb[-1]
-            E_ref = np.copy(f.variables['a_Er'][1,z_idx,:] + \
-                            1j*f.variables['a_Ei'][1,z_idx,:])*D_ephi**2
-            f.close()
-
-            receiver = c5.C5_reader(rec_file)
-
-            E_rec = receiver.E_re_interp(z,y) + 1j* receiver.E_im_interp(z,y)
-            
-            E_out = np.trapz(E_ref*np.conj(E_rec[z_idx,:]),x=y)
-            return E_out
-            
-        elif(self.dimension == 3):
-            y = np.copy(f.variables['a_y'][:])
-            z = np.copy(f.variables['a_z'][:])
-            
-            E_ref_re_interp = interp2d(y,z,f.variables['a_Er'][1,:,:],
-                                       kind='cubic', fill_value=0)
-            E_ref_im_interp = interp2d(y,z,f.variables['a_Ei'][1,:,:],
-                                       kind='cubic', fill_value=0)            
-            f.close()
-
-            receiver = c5.C5_reader(rec_file)
-            
-            #use area average to estimate E_ref*np.conj(E_receive) integrated over y,z dimension.
-            ymin = np.max([y[0], receiver.X1D[0]])
-            ymax = np.min([y[-1], receiver.X1D[-1]])
-            zmin = np.max([z[0], receiver.Y1D[0]])
-            zmax = np.min([z[-1], receiver.Y1D[-1]])
-            y_fine = np.linspace(ymin, ymax, 200)
-            z_fine = np.linspace(zmin, zmax, 200)
-            self.E_ref = E_ref_re_interp(y_fine, z_fine)+ \
-                         1j*E_ref_im_interp(y_fine, z_fine)
-            self.E_rec = receiver.E_re_interp(z_fine,y_fine)+ \
-                         1j*receiver.E_im_interp(z_fine,y_fine)
-            
-            E_conv = self.E_ref*np.conj(self.E_rec)
-
-            dy = y_fine[1] - y_fine[0]
-            dz = z_fine[1] - z_fine[0]
-            
-            # integration over y direction
-            SEy = np.sum(E_conv[:,:-1] + E_conv[:,1:], axis=1)/2*dy 
-            # integration over z direction
-            E_out = np.sum(SEy[:-1] + SEy[1:])/2*dz 
-            return E_out
+        E_out, E_ref, E_rec = _read_E_out(ref_file, rec_file, self.dimension,
+                                          self._receivers)
+        if(self.dimension == 3):
+            self.E_ref = E_ref
+            self.E_rec = E_rec
+        return E_out
 
     
     def save_E_out(self, filename='E_out.sav'):
@@ -184,19 +286,46 @@ somewhere else.')
         np.save(path.join(self.file_path,filename), self.E_out)
 
     
-    def load_E_out(self, filename='E_out.sav'):
+    def load_E_out(self, filename='E_out.sav', mmap_mode=None):
         """load an existing E_out array from previously saved datafile.
         Default filename is E_out.sav.npy
         Note that a '.npy' extension will be automatically added if not given in filename.
+        mmap_mode: passed to np.load. Use 'r' to memory-map the file instead 
+        of reading it all in, so only the parts actually used are loaded. 
+        Default is None, the whole array is read into memory.
         """
         if('.npy' not in filename):
             filename = filename + '.npy'
-        self.E_out =  np.load(path.join(self.file_path, filename))
+        self.E_out =  np.load(path.join(self.file_path, filename),
+                              mmap_mode=mmap_mode)
         
         
 
 #TODO Check the status of these funcions and delete deprecated ones.
 
+def _correlation_sums(M_flat, block_size=65536):
+    """sums of M_flat[i]*conj(M_flat[j]) over the second axis, for all pairs 
+    of rows (i,j)
+    
+    Each block of block_size columns is done by one matrix product, and the 
+    blocks are accumulated, so the conjugated copy needed by the product stays 
+    small for very long signals.
+    """
+    NF = M_flat.shape[0]
+    S = np.zeros((NF,NF), dtype=np.result_type(M_flat.dtype, np.complex128))
+    for k in range(0, M_flat.shape[1], block_size):
+        block = M_flat[:,k:k+block_size]
+        S += np.dot(block, block.T.conj())
+    return S
+
+
+def _mean_over_tn(M):
+    """average over all but the first axis, i.e. over time steps and 
+    cross-sections, in one reduction
+    """
+    return M.reshape((M.shape[0],-1)).mean(axis=1)
+
+
 def Self_Correlation(ref_output,tstart=None, tend=None):
     """Calculate the self correlation function for each frequency
 
@@ -217,9 +346,9 @@ def Self_Correlation(ref_output,tstart=None, tend=None):
     else:
         M = ref_output.E_out[:,tstart:tend+1,:]
 
-    M_bar = np.average(np.average(M,axis = 2),axis = 1)
+    M_bar = _mean_over_tn(M)
 
-    M2_bar = np.average(np.average(M*np.conj(M),axis = 2),axis = 1)
+    M2_bar = _mean_over_tn(M.real**2 + M.imag**2)
 
     return M_bar/np.sqrt(M2_bar)
 
@@ -239,22 +368,16 @@ def Cross_Correlation(ref_output):
     M = ref_output.E_out
     NF = ref_output.NF
     
-    r = np.zeros((NF,NF))
-    r = r + 1j*r
-
-    M2_bar = np.average(np.average(M*np.conj(M),axis = 2),axis=1)
-        
-    for f0 in np.arange(NF):
-        M0 = M[f0,...]        
-        for f1 in np.arange(NF):
-            if (f1 >= f0):
-                M1 = M[f1,...]
-                cross_bar = np.average(np.average(M0 * np.conj(M1),axis = 1),axis=0)
-                denominator = np.sqrt(M2_bar[f0]*M2_bar[f1])
-                r[f0,f1] = cross_bar / denominator
-                r[f1,f0] = np.conj(r[f0,f1])
-            else:
-                pass
+    M2_bar = _mean_over_tn(M.real**2 + M.imag**2)
+    
+    # all the averages <M(w0)M*(w1)> are obtained by one matrix product of the
+    # signals flattened over time steps and cross-sections
+    M_flat = M.reshape((NF,-1))
+    cross_bar = _correlation_sums(M_flat)/M_flat.shape[1]
+    r = cross_bar/np.sqrt(np.outer(M2_bar,M2_bar))
+    
+    # make the off-diagonal part of r exactly Hermitian, using the upper triangle
+    r = np.triu(r) + np.triu(r,1).T.conj()
 
     return r
 
@@ -262,6 +385,8 @@ def Cross_Correlation(ref_output):
 def Cross_Correlation_by_fft(ref_output):
     """Calculate teh cross correlation using fft method. Details can be found in Appendix part of ref.[1]
 
+    Only the zero time delay correlation is returned, which is evaluated in the time domain using Parseval's theorem.
+
     [1] Observation of ion scale fluctuations in the pedestal region during the edge-localized-mode cycle on the National Spherical torus Experiment. A.Diallo, G.J.Kramer, at. el. Phys. Plasmas 20, 012505(2013)
     """
 
@@ -272,29 +397,16 @@ def Cross_Correlation_by_fft(ref_output):
 
     E = E.reshape((NF,NT*n_cross)) #reshape the signal such that all the data from one frequency channel forms a one dimensional array
 
-    r = np.zeros((NF,NF))
-    r = r + r*1j #the complex array for results
-
-    F = np.fft.fft(E,axis = 1)
-    F2 = np.conj(F)*F
-    F_norm = np.sqrt(np.average(F2,axis = 1))
-    for i in range(NF):
-        f = F[i,:]
-        f2 = F2[i,:]
-        f_norm = F_norm[i]
-        for j in range(NF):
-            if(j==i):
-                gamma_f = f2/f_norm**2
-                gamma_t = np.fft.ifft(gamma_f)
-                r[i,i] = gamma_t[0]
-            elif(j>i):
-                g = F[j,:]
-                g_norm = F_norm[j]
-                gamma_f = np.conj(f)*g/(f_norm*g_norm)
-                gamma_t = np.fft.ifft(gamma_f)
-                r[i,j] = gamma_t[0]
-            else:
-                r[i,j] = np.conj(r[j,i])
+    # only the zero delay correlation, the zeroth component of 
+    # ifft(conj(F_i)*F_j), is used. By Parseval's theorem it equals the
+    # time domain sum of conj(E_i)*E_j normalized by the norms of E_i and E_j,
+    # so no fft is needed. All the pairs are obtained by one matrix product.
+    E_norm = np.sqrt(np.sum(E.real**2 + E.imag**2,axis = 1))
+    gamma = np.conj(_correlation_sums(E))
+    r = gamma/np.outer(E_norm,E_norm)
+    
+    # make the off-diagonal part of r exactly Hermitian, using the upper triangle
+    r = np.triu(r) + np.triu(r,1).T.conj()
     return r
 
 
@@ -325,14 +437,27 @@ def fitting_cross_correlation(cross_cor_arr,dx_arr,fitting_type = 'gaussian'):
 
     if(fitting_type == 'gaussian'):
         fit_func = gaussian_fit
+        u = np.asarray(dx_arr,dtype=float)**2
     elif(fitting_type == 'exponential'):
         fit_func = exponential_fit
+        u = np.abs(np.asarray(dx_arr,dtype=float))
     else:
         print('unknown fitting type:'+fitting_type)
         print('choose from gaussian or exponential')
         return (-1,-1)
 
-    a,sigma_a2 = curve_fit(fit_func,dx_arr,cross_cor_arr)
+    # Both models are linear in log-space, log(y) = -u/a, so the least square 
+    # solution through the origin gives a close starting guess and curve_fit 
+    # only needs a few iterations to refine it. Fall back to the default guess 
+    # if the log-space estimate is not usable.
+    p0 = None
+    y = np.asarray(cross_cor_arr,dtype=float)
+    if np.all(y > 0):
+        inv_a = -np.sum(u*np.log(y))/np.sum(u*u)
+        if np.isfinite(inv_a) and inv_a > 0:
+            p0 = [1/inv_a]
+
+    a,sigma_a2 = curve_fit(fit_func,dx_arr,cross_cor_arr,p0=p0)
 
     return (a,np.sqrt(sigma_a2))
     
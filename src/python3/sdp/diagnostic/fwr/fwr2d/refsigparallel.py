@@ -7,49 +7,33 @@ Created on Mon Apr  6 14:01:05 2015
 Multiprocess version to calculate reflected signals from FWR2D/3D
 
 useful when have multiple frequencies and time steps to analyse
+
+This version uses a standard multiprocessing pool. The python2 copy of this
+module still uses IPython.parallel, and needs ipcluster to be started with 
+the required number of engines.
 """
 
-# using IPython multiprocessing modules, need ipcluster to be started.
-import time
+# using the standard multiprocessing module, worker processes import modules
+# normally, no ipcluster is needed.
+import multiprocessing as mp
 
-from IPython.parallel import Client
 import numpy as np
 
 from . import postprocess as pp
 
-def dv_initialize(n_engine,profile = 'default'):
-    c = Client(profile=profile)
-    
-    # The engine needs time to start, so check when all the engines are 
-    # connected before take a direct view of the cluster.
-    
-    # Make sure this desired_engine_num is EXACTLY the same as the engine 
-    # number you initiated with ipengine
-    desired_engine_num = n_engine 
-    
-    # check if the engines are ready, if the engines are not ready after 1 min,
-    # something might be wrong. Exit and raise an exception.
-    waiting=0
-    while(len(c) < desired_engine_num and waiting<=60):
-        time.sleep(10)
-        waiting += 10
-    
-    if(len(c) != desired_engine_num):
-        raise Exception('usable engine number is not the same as the desired \
-engine number! usable:{0}, desired:{1}.\nCheck your cluster status and the \
-desired number set in the Driver script.'.format(len(c),desired_engine_num))
+def dv_initialize(n_engine, profile=None):
+    """Start a pool of worker processes to run the single frequency-time 
+    calculations.
     
+    :param int n_engine: number of worker processes
+    :param profile: no longer used, it was the ipcluster profile name. Still 
+                    accepted so that existing driver scripts keep working.
     
-    dv = c[:]
-    
-    with dv.sync_imports():
-        import sdp.diagnostic.fwr.fwr2d.postprocess
-        import numpy 
-    
-    dv.execute('pp=sdp.diagnostic.fwr.fwr2d.Postprocess')
-    dv.execute('np=numpy')
-    
-    return dv
+    :returns: :py:class:`multiprocessing.Pool` object, to be passed to 
+              :py:func:`full_freq_time`. Call its close() and join() methods 
+              when all calculations are finished.
+    """
+    return mp.Pool(n_engine)
 
 class Reflectometer_Output_Params:
     """container for non-essential parameters used in Reflectometer_Output 
@@ -114,8 +98,7 @@ def full_freq_time(freqs, time_arr, Ref_param, dv):
     :type time_arr: array of ints
     :param Ref_param: containing other preset parameters
     :type Ref_param: :py:class`Reflectometer_Output_Params` object
-    :param dv: direct-view of an IPython parallel cluster, obtained by function
-               dv_initialize()
+    :param dv: pool of worker processes, obtained by function dv_initialize()
     
     :returns: Reflectometer_Output object with parameters given by freqs, 
               time_arr, and Ref_param. Its E_out attribute contains the 
@@ -129,16 +112,14 @@ def full_freq_time(freqs, time_arr, Ref_param, dv):
                              dtype='complex')
     
     parallel_param_list = [(f,t,Ref_param) for f in freqs for t in time_arr]
-    parallel_result = dv.map_async(single_freq_time, parallel_param_list)
     print('Parallel runs started.')
-    parallel_result.wait_interactive()
-    print('All signals computed!')
-    E_out_scattered = parallel_result.get()
-    print('signals collected.')
-    for i in range(Ref_all.NF):
-        for j in range(Ref_all.NT):
-            Ref_all.E_out[i, j, :] = E_out_scattered[i*len(time_arr)+j][0, 0,:]
-            print(('freq {0},time {1} stored.'.format(freqs[i], time_arr[j])))
+    E_out_scattered = dv.map(single_freq_time, parallel_param_list)
+    print('All signals computed and collected!')
+    # results are ordered with time changing fastest, same as E_out's (NF,NT)
+    Ref_all.E_out[...] = np.asarray(E_out_scattered)[:, 0, 0, :].reshape(
+                                                       Ref_all.E_out.shape)
+    print('{0} frequencies, {1} time steps stored.'.format(Ref_all.NF, 
+                                                           Ref_all.NT))
             
     return Ref_all
     
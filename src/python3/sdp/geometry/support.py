@@ -6,6 +6,8 @@ Created on Fri Oct 16 10:35:35 2015
 
 @author: lei
 """
+import inspect
+
 import numpy as np
 from matplotlib.tri import TriFinder
 from scipy.spatial import Delaunay
@@ -41,3 +43,57 @@ class DelaunayTriFinder(TriFinder):
         p = np.array([x,y]).transpose(axes)
         
         return self.delaunay.find_simplex(p)
+
+
+def _has_multikeys(interp):
+    """True if the private matplotlib method _interpolate_multikeys of 
+    *interp* exists and accepts the tri_index and return_keys arguments"""
+    method = getattr(interp, '_interpolate_multikeys', None)
+    if method is None:
+        return False
+    try:
+        params = inspect.signature(method).parameters
+    except (TypeError, ValueError):
+        return False
+    return 'tri_index' in params and 'return_keys' in params
+
+
+# A helper class for evaluating several matplotlib.tri interpolators defined on the same triangulation, e.g. the components of a vector field. The containing triangles are searched only once for all the quantities.
+class MultiTriInterpolator(object):
+    """Evaluate several interpolators on the same triangulation with one triangle search
+
+    The triangle indices are passed to the private matplotlib method 
+    :py:meth:`TriInterpolator._interpolate_multikeys`, which is not part of the
+    public matplotlib API. It is checked once when the object is created, if
+    it is missing or its signature has changed, the public 
+    :py:meth:`TriInterpolator.__call__` of each interpolator is used instead, 
+    which searches the triangles once per quantity.
+    """
+
+    def __init__(self, interpolators, trifinder):
+        """ Group the interpolators sharing the same triangulation and trifinder
+        Compatibility is not checked!
+        User must make sure all the interpolators are created on the same triangulation, using the given *trifinder*.
+
+            :param interpolators: interpolators for each quantity
+            :type interpolators: list of :py:class:`matplotlib.tri.TriInterpolator` objects
+            :param trifinder: the TriFinder used by all the interpolators
+            :type trifinder: :py:class:`matplotlib.tri.TriFinder` object
+        """
+        self.interpolators = list(interpolators)
+        self.trifinder = trifinder
+        self._use_multikeys = all(_has_multikeys(interp) for interp in self.interpolators)
+
+    def __call__(self,x,y):
+        """ interpolate all the quantities at given points
+            :param x: x coordinates of specified points
+            :type x: numpy array of float
+            :param y: y coordinates of specified points
+            :type y: numpy array of float
+            :return: interpolated values for each quantity, in the same order as *interpolators*. Points outside the triangulation are masked.
+            :rtype: list of numpy masked arrays
+        """
+        if self._use_multikeys:
+            tri_index = self.trifinder(x,y)
+            return [interp._interpolate_multikeys(x, y, tri_index=tri_index, return_keys=('z',))[0] for interp in self.interpolators]
+        return [interp(x,y) for interp in self.interpolators]
@@ -2,16 +2,23 @@
 """Load XGC output data, interpolate electron density perturbation onto desired Cartesian grid mesh. 
 """
 from ...geometry.grid import Cartesian2D,Cartesian3D
-from ...geometry.support import DelaunayTriFinder
+from ...geometry.support import DelaunayTriFinder, MultiTriInterpolator
 from ...io.funcs import load_m
 from ...math.rungekutta import runge_kutta_explicit
 
+import os
+import atexit
 import numpy as np
 import h5py as h5
-from scipy.spatial import Delaunay, ConvexHull
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+import itertools
+import zlib
+from scipy.spatial import Delaunay, ConvexHull, cKDTree
 from matplotlib.tri import Triangulation
 from matplotlib.tri import CubicTriInterpolator as cubic_interp
-from scipy.interpolate import griddata,CloughTocher2DInterpolator,interp1d,RectBivariateSpline
+from scipy.interpolate import CloughTocher2DInterpolator,interp1d,RectBivariateSpline
+from scipy.ndimage import map_coordinates,spline_filter
 import scipy.io.netcdf as nc
 #import pickle
 
@@ -20,28 +27,128 @@ import scipy.io.netcdf as nc
 def get_interp_planes(my_xgc):
     """Get the plane numbers used for interpolation for each point 
     """
-    dPHI = 2 * np.pi / my_xgc.n_plane
-    phi_planes = np.arange(my_xgc.n_plane)*dPHI
+    dPHI = my_xgc.dPHI
+    phi_planes = my_xgc.phi_planes
+    phi3D = my_xgc.grid.phi3D
+    # planes are uniformly spaced, so the number of planes at or before phi is obtained arithmetically, the same as np.searchsorted(phi_planes,phi3D,side = 'right').
+    n_before = np.clip(np.floor(phi3D/dPHI).astype(int) + 1, 0, my_xgc.n_plane)
+    # floor may be off by one due to round-off when phi is (almost) exactly on a plane, correct it by comparing with the plane positions
+    lower = np.concatenate(([-np.inf],phi_planes))
+    upper = np.concatenate((phi_planes,[np.inf]))
+    n_before -= (phi3D < lower[n_before])
+    n_before += (phi3D >= upper[n_before])
     if(my_xgc.CO_DIR):
-        nextplane = np.searchsorted(phi_planes,my_xgc.grid.phi3D,side = 'right')
+        nextplane = n_before
         prevplane = nextplane - 1
         nextplane[np.nonzero(nextplane == my_xgc.n_plane)] = 0
     else:
-        prevplane = np.searchsorted(phi_planes,my_xgc.grid.phi3D,side = 'right')
+        prevplane = n_before
         nextplane = prevplane - 1
         prevplane[np.nonzero(prevplane == my_xgc.n_plane)] = 0
 
     return (prevplane,nextplane)
     
 
-def find_interp_positions_v2_upgrade(my_xgc,Nstep = 10):
+def _field_line_derivatives(B,R,Z,K):
+    """Evaluate dR/dphi, dZ/dphi and ds/dphi along the field line at (R,Z), results are written into K[:,0], K[:,1] and K[:,2].
+
+    B is the interpolator returning (BR,BZ,BPhi) at given (Z,R).
+    """
+    BRtemp,BZtemp,BPhitemp = B(Z,R)
+    #outside points are masked in all the components, set BR and BZ to be zero there
+    inside = ~np.ma.getmaskarray(BPhitemp)
+    bR = np.divide(BRtemp.data, BPhitemp.data, out = np.zeros(R.shape), where = inside)
+    bZ = np.divide(BZtemp.data, BPhitemp.data, out = np.zeros(R.shape), where = inside)
+
+    K[:,0] = R * bR
+    K[:,1] = R * bZ
+    K[:,2] = np.sqrt(1.0 + bR**2 + bZ**2)* R
+
+
+def _trace_field_line(B,R,Z,s,phi,dphi,direction,chunk_size = 32768):
+    """Trace the field lines starting at (R,Z) by toroidal angle *phi* using the 2nd order Runge-Kutta method with maximum step size *dphi*.
+
+    R, Z and s are updated in place, phi is consumed (set to 0 when tracing is finished).
+
+    Points are traced in chunks of *chunk_size*, all the steps of one chunk are finished before moving on to the next one, so the working arrays of a chunk stay in cache between steps.
+    """
+    # Coefficient of the Runge-Kutta method
+    a,b,c,Nstage = runge_kutta_explicit(2)
+    # stage buffer allocated once, sliced to the number of active points in each step
+    K = np.empty((min(R.size,chunk_size),3,Nstage),dtype = R.dtype)
+    for start in range(0,R.size,chunk_size):
+        chunk = slice(start,start+chunk_size)
+        _trace_field_line_chunk(B,R[chunk],Z[chunk],s[chunk],phi[chunk],dphi,a,b,K)
+        print('{0} tracing finished for points {1} to {2}.'.format(direction,start,min(start+chunk_size,R.size)))
+
+
+def _trace_field_line_chunk(B,R,Z,s,phi,dphi,a,b,K):
+    """Runge-Kutta tracing loop for one chunk of points, see :py:func:`_trace_field_line`. a and b are the Butcher table coefficients, K is the stage buffer.
+    """
+    # number of steps needed for each point, all steps are of size dphi except the last one, which covers what is left of phi. Counting steps avoids testing the floating point remainder of phi against 0.
+    n_steps = np.ceil(np.abs(phi)/np.abs(dphi)).astype(int)
+    # the points still being integrated are kept in compacted contiguous arrays, finished points are written back and dropped from them
+    idx = np.flatnonzero(n_steps)
+    R_act = R[idx]
+    Z_act = Z[idx]
+    s_act = s[idx]
+    n_left = n_steps[idx]
+    last_step = phi[idx] - (n_left-1)*dphi
+    while idx.size > 0:
+        # size of the next step for each position
+        step = np.where(n_left == 1, last_step, dphi)
+        n_left -= 1
+        Kn = K[:idx.size]
+        # the two stages are written out explicitly
+        _field_line_derivatives(B,R_act,Z_act,Kn[:,:,0])
+        _field_line_derivatives(B,R_act+step*a[1,0]*Kn[:,0,0],Z_act+step*a[1,0]*Kn[:,1,0],Kn[:,:,1])
+
+        s_act += np.abs(step)*(b[0]*Kn[:,2,0] + b[1]*Kn[:,2,1])
+        Z_act += step*(b[0]*Kn[:,1,0] + b[1]*Kn[:,1,1])
+        R_act += step*(b[0]*Kn[:,0,0] + b[1]*Kn[:,0,1])
+
+        # update the global value for the finished points
+        done = (n_left == 0)
+        if done.any():
+            idx_done = idx[done]
+            R[idx_done] = R_act[done]
+            Z[idx_done] = Z_act[done]
+            s[idx_done] = s_act[done]
+            keep = ~done
+            idx = idx[keep]
+            R_act = R_act[keep]
+            Z_act = Z_act[keep]
+            s_act = s_act[keep]
+            n_left = n_left[keep]
+            last_step = last_step[keep]
+    phi[:] = 0
+
+
+def _pack_interp_positions(Z_BWD,R_BWD,s_BWD,Z_FWD,R_FWD,s_FWD,shape):
+    """Pack the traced positions and arc lengths into the (2,3,NZ,NY,NX) interpolation position array.
+
+    Since the leading two dimensions are the slowest varying ones, each (Z,R,portion) field is stored as a contiguous (NZ,NY,NX) block, and can be read out as a view like interp_positions[0,0].
+    """
+    interp_positions = np.empty((2,3)+shape)
+
+    interp_positions[0,0,...] = Z_BWD.reshape(shape)
+    interp_positions[0,1,...] = R_BWD.reshape(shape)
+    np.divide(s_BWD,s_BWD+s_FWD,out = interp_positions[0,2].reshape(-1))
+    interp_positions[1,0,...] = Z_FWD.reshape(shape)
+    interp_positions[1,1,...] = R_FWD.reshape(shape)
+    np.subtract(1,interp_positions[0,2],out = interp_positions[1,2])
+
+    return interp_positions
+
+
+def find_interp_positions_v2_upgrade(my_xgc,Nstep = 10,dtype = np.float64):
     """Upgrade version for finding interpolation position function version 2.
     Field line tracing is calculated more effeciently. For points at different portion of toroidal sections, forward and backward steps are calculated for a given toroidal proceeding angle, i.e. dphi
     Additionally, Runge-Kutta method is employed to integrate dR and dZ for each step, thus larger dphi can be used to eventually save some time.
+
+    dtype is the floating point type used to store the traced R,Z positions and the Runge-Kutta stages, np.float32 halves the memory of the tracing arrays. The arc lengths are always accumulated in double precision. Note that the magnetic field interpolation is always done in double precision by matplotlib.
     """
-    BR = my_xgc.BR_interp
-    BZ = my_xgc.BZ_interp
-    BPhi = my_xgc.BPhi_interp
+    B = my_xgc.Bvec_interp
 
     r3D = my_xgc.grid.r3D
     z3D = my_xgc.grid.z3D
@@ -51,16 +158,17 @@ def find_interp_positions_v2_upgrade(my_xgc,Nstep = 10):
     NY = r3D.shape[1]
     NX = r3D.shape[2]
 
-    Rwant = r3D.flatten()
-    Zwant = z3D.flatten()
-    Phiwant = phi3D.flatten()
+    # flattened views, these arrays are only read
+    Rwant = r3D.ravel()
+    Zwant = z3D.ravel()
+    Phiwant = phi3D.ravel()
 
-    prevplane,nextplane = my_xgc.prevplane.flatten(),my_xgc.nextplane.flatten()
+    prevplane,nextplane = my_xgc.prevplane.ravel(),my_xgc.nextplane.ravel()
 
-    dPhi = 2*np.pi/my_xgc.n_plane# DPhi is the toroidal angle between two adjecent cross sections
+    dPhi = my_xgc.dPHI# DPhi is the toroidal angle between two adjecent cross sections
     dphi = dPhi/Nstep #dphi is the toroidal step size for tracing the field line between two cross sections
     
-    phi_planes = np.arange(my_xgc.n_plane)*dPhi
+    phi_planes = my_xgc.phi_planes
 
     #Caluclate the toroidal angle difference from nextplane and prevplane. Caution needs to be taken for the points near plane[0], because it's phi value is by default 0, but sometimes, when the wanted phi is close to 2pi, to calculate the difference between them, it's phi value needs to be considered as 2pi.
     if(my_xgc.CO_DIR):
@@ -74,112 +182,19 @@ def find_interp_positions_v2_upgrade(my_xgc,Nstep = 10):
         FWD_sign = -1
         BWD_sign = 1
 
-    R_FWD = np.copy(Rwant)
-    R_BWD = np.copy(Rwant)
-    Z_FWD = np.copy(Zwant)
-    Z_BWD = np.copy(Zwant)
-    s_FWD = np.zeros(Rwant.shape)
-    s_BWD = np.zeros(Rwant.shape)
-    
-    
-    # check which index need to be integrated
-    ind = np.ones(Rwant.shape,dtype=bool)
-    # Coefficient of the Runge-Kutta method
-    a,b,c,Nstage = runge_kutta_explicit(2)
+    # tracing states are kept in one contiguous block
+    scratch = np.empty((4,Rwant.size),dtype = dtype)
+    scratch[0:2] = Rwant
+    scratch[2:4] = Zwant
+    R_FWD,R_BWD,Z_FWD,Z_BWD = scratch
+    s_FWD,s_BWD = np.zeros((2,Rwant.size))
+
     # forward step
-    while ind.any():
-        # size of the next step for each position
-        step = phiFWD[ind]
-        step[np.abs(step) > dphi] = FWD_sign * dphi
-        # update the position of the next iteration
-        phiFWD[ind] -= step
-        K = np.zeros((Rwant[ind].shape[0],3,Nstage))
-        for i in range(Nstage):
-            # compute the coordinates of this stage
-            Rtemp = R_FWD[ind] + step*np.sum(a[i,:i]*K[:,0,:i],axis=1)
-            Ztemp = Z_FWD[ind] + step*np.sum(a[i,:i]*K[:,1,:i],axis=1)
-            BPhitemp = BPhi(Ztemp,Rtemp)
-            BRtemp = BR(Ztemp,Rtemp)
-            BZtemp = BZ(Ztemp,Rtemp)
-            #clean the outside points for BR and BZ, set all infinite points to be zero
-            BRtemp[~np.isfinite(BRtemp)] = 0            
-            BZtemp[~np.isfinite(BZtemp)] = 0
-            
-            # evaluate the function
-            K[:,0,i] = Rtemp * BRtemp / BPhitemp
-            K[:,1,i] = Rtemp * BZtemp / BPhitemp
-            K[:,2,i] = np.sqrt(1.0 + (BRtemp/BPhitemp)**2 + (BZtemp/BPhitemp)**2)* Rtemp
-
-        # compute the final value of this step
-        dR_FWD = step*np.sum(b[np.newaxis,:]*K[:,0,:],axis=1)
-        dZ_FWD = step*np.sum(b[np.newaxis,:]*K[:,1,:],axis=1)
-        ds_FWD = np.abs(step)*np.sum(b[np.newaxis,:]*K[:,2,:],axis=1)
-        
-        #when the point gets outside of the XGC mesh, set BR,BZ to zero.
-        #dR_FWD[~np.isfinite(dR_FWD)] = 0.0
-        #dZ_FWD[~np.isfinite(dZ_FWD)] = 0.0
-        #ds_FWD[~np.isfinite(ds_FWD)] = 0.0
-
-        # update the global value
-        s_FWD[ind] += ds_FWD
-        Z_FWD[ind] += dZ_FWD
-        R_FWD[ind] += dR_FWD
-        ind = (phiFWD != 0)
-        print('one forward step finished.')
-
-    # check which index need to be integrated
-    ind = np.ones(Rwant.shape,dtype=bool)
+    _trace_field_line(B,R_FWD,Z_FWD,s_FWD,phiFWD,FWD_sign*dphi,'forward')
     # backward step
-    while ind.any():
-        # size of the next step for each position
-        step = phiBWD[ind]
-        step[np.abs(step) > dphi] = BWD_sign * dphi
-        # update the position of the next iteration
-        phiBWD[ind] -= step
-        K = np.zeros((Rwant[ind].shape[0],3,Nstage))
-        for i in range(Nstage):
-            # compute the coordinates of this stage
-            Rtemp = R_BWD[ind] + step*np.sum(a[i,:i]*K[:,0,:i],axis=1)
-            Ztemp = Z_BWD[ind] + step*np.sum(a[i,:i]*K[:,1,:i],axis=1)
-            BPhitemp = BPhi(Ztemp,Rtemp)
-            BRtemp = BR(Ztemp,Rtemp)
-            BZtemp = BZ(Ztemp,Rtemp)
-            #clean the outside points for BR and BZ, set all infinite points to be zero
-            BRtemp[~np.isfinite(BRtemp)] = 0            
-            BZtemp[~np.isfinite(BZtemp)] = 0
-            
-            # evaluate the function
-            K[:,0,i] = Rtemp * BRtemp / BPhitemp
-            K[:,1,i] = Rtemp * BZtemp / BPhitemp
-            K[:,2,i] = np.sqrt(1.0 + (BRtemp/BPhitemp)**2 + (BZtemp/BPhitemp)**2)* Rtemp
-
-        # compute the final value of this step
-        dR_BWD = step*np.sum(b[np.newaxis,:]*K[:,0,:],axis=1)
-        dZ_BWD = step*np.sum(b[np.newaxis,:]*K[:,1,:],axis=1)
-        ds_BWD = np.abs(step)*np.sum(b[np.newaxis,:]*K[:,2,:],axis=1)
-        
-        #when the point gets outside of the XGC mesh, set BR,BZ to zero.
-        #dR_BWD[~np.isfinite(dR_BWD)] = 0.0
-        #dZ_BWD[~np.isfinite(dZ_BWD)] = 0.0
-        #ds_BWD[~np.isfinite(ds_BWD)] = 0.0
-
-        # update the global value
-        s_BWD[ind] += ds_BWD
-        Z_BWD[ind] += dZ_BWD
-        R_BWD[ind] += dR_BWD
-        ind = (phiBWD != 0)
-        print('one backward step finished.')
-    
-    interp_positions = np.zeros((2,3,NZ,NY,NX))
+    _trace_field_line(B,R_BWD,Z_BWD,s_BWD,phiBWD,BWD_sign*dphi,'backward')
 
-    interp_positions[0,0,...] = Z_BWD.reshape((NZ,NY,NX))
-    interp_positions[0,1,...] = R_BWD.reshape((NZ,NY,NX))    
-    interp_positions[0,2,...] = (s_BWD/(s_BWD+s_FWD)).reshape((NZ,NY,NX))
-    interp_positions[1,0,...] = Z_FWD.reshape((NZ,NY,NX))
-    interp_positions[1,1,...] = R_FWD.reshape((NZ,NY,NX))
-    interp_positions[1,2,...] = 1-interp_positions[0,2,...]
-
-    return interp_positions
+    return _pack_interp_positions(Z_BWD,R_BWD,s_BWD,Z_FWD,R_FWD,s_FWD,(NZ,NY,NX))
 
     
 def find_interp_positions_v2(my_xgc):
@@ -188,9 +203,7 @@ def find_interp_positions_v2(my_xgc):
     argument and return value are the same as find_interp_positions_v1. 
     """
 
-    BR = my_xgc.BR_interp
-    BZ = my_xgc.BZ_interp
-    BPhi = my_xgc.BPhi_interp
+    B = my_xgc.Bvec_interp
 
     r3D = my_xgc.grid.r3D
     z3D = my_xgc.grid.z3D
@@ -200,15 +213,16 @@ def find_interp_positions_v2(my_xgc):
     NY = r3D.shape[1]
     NX = r3D.shape[2]
 
-    Rwant = r3D.flatten()
-    Zwant = z3D.flatten()
-    Phiwant = phi3D.flatten()
+    # flattened views, these arrays are only read
+    Rwant = r3D.ravel()
+    Zwant = z3D.ravel()
+    Phiwant = phi3D.ravel()
 
-    prevplane,nextplane = my_xgc.prevplane.flatten(),my_xgc.nextplane.flatten()
+    prevplane,nextplane = my_xgc.prevplane.ravel(),my_xgc.nextplane.ravel()
 
-    dPhi = 2*np.pi/my_xgc.n_plane
+    dPhi = my_xgc.dPHI
     
-    phi_planes = np.arange(my_xgc.n_plane)*dPhi
+    phi_planes = my_xgc.phi_planes
 
     #Caluclate the toroidal angle difference from nextplane and prevplane. Caution needs to be taken for the points near plane[0], because it's phi value is by default 0, but sometimes, when the wanted phi is close to 2pi, to calculate the difference between them, it's phi value needs to be considered as 2pi.
     if(my_xgc.CO_DIR):
@@ -219,70 +233,29 @@ def find_interp_positions_v2(my_xgc):
         phiBWD = np.where(prevplane ==0,np.pi*2 - Phiwant, phi_planes[prevplane]-Phiwant)
 
     N_step = 10
-    dphi_FWD = phiFWD/N_step
-    dphi_BWD = phiBWD/N_step
-    R_FWD = np.copy(Rwant)
-    R_BWD = np.copy(Rwant)
-    Z_FWD = np.copy(Zwant)
-    Z_BWD = np.copy(Zwant)
-    s_FWD = np.zeros(Rwant.shape)
-    s_BWD = np.zeros(Rwant.shape)
+    # forward and backward tracing are independent for every point, so both are carried out together in one set of arrays, the first half being forward and the second half backward.
+    N = Rwant.size
+    dphi = np.concatenate((phiFWD,phiBWD))/N_step
+    R_all = np.concatenate((Rwant,Rwant))
+    Z_all = np.concatenate((Zwant,Zwant))
+    s_all = np.zeros(2*N)
+    K = np.empty((2*N,3))
     for i in range(N_step):
         
         print('step {0} started'.format(i))
 
-        RdPhi_FWD = R_FWD*dphi_FWD
-        BPhi_FWD = BPhi(Z_FWD,R_FWD)
-        BR_FWD = BR(Z_FWD,R_FWD)
-        BZ_FWD = BZ(Z_FWD,R_FWD)
-        
-        #outside points are flaged with np.inf, need to be set to zero before use
-        BR_FWD[~np.isfinite(BR_FWD)] = 0  
-        BZ_FWD[~np.isfinite(BZ_FWD)] = 0
-        
-        dR_FWD = RdPhi_FWD * BR_FWD/ BPhi_FWD
-        dZ_FWD = RdPhi_FWD * BZ_FWD / BPhi_FWD
-        
-        s_FWD += np.sqrt(RdPhi_FWD**2 + dR_FWD**2 + dZ_FWD**2)
-        R_FWD += dR_FWD
-        Z_FWD += dZ_FWD
+        _field_line_derivatives(B,R_all,Z_all,K)
+        s_all += np.abs(dphi)*K[:,2]
+        R_all += dphi*K[:,0]
+        Z_all += dphi*K[:,1]
 
-        print('forward step completed.')
-        
-        RdPhi_BWD = R_BWD*dphi_BWD
-        BPhi_BWD = BPhi(Z_BWD,R_BWD)
-        
-        BR_BWD = BR(Z_BWD,R_BWD)
-        BZ_BWD = BZ(Z_BWD,R_BWD)
-        
-        #outside points are flaged with np.inf, need to be set to zero before use
-        BR_BWD[~np.isfinite(BR_BWD)] = 0  
-        BZ_BWD[~np.isfinite(BZ_BWD)] = 0
-        
-        dR_BWD = RdPhi_BWD * BR_BWD / BPhi_BWD
-        dZ_BWD = RdPhi_BWD * BZ_BWD / BPhi_BWD
-        
-        ind = np.where(np.abs(dR_BWD) == np.inf)[0]
-        dR_BWD[ind] = 0.0
-        ind = np.where(np.abs(dZ_BWD) == np.inf)[0]
-        dZ_BWD[ind] = 0.0
-        
-        s_BWD += np.sqrt(RdPhi_BWD**2 + dR_BWD**2 + dZ_BWD**2)
-        R_BWD += dR_BWD
-        Z_BWD += dZ_BWD
-        
-        print('backward step completed.')
-
-    interp_positions = np.zeros((2,3,NZ,NY,NX))
+        print('forward and backward steps completed.')
 
-    interp_positions[0,0,...] = Z_BWD.reshape((NZ,NY,NX))
-    interp_positions[0,1,...] = R_BWD.reshape((NZ,NY,NX))    
-    interp_positions[0,2,...] = (s_BWD/(s_BWD+s_FWD)).reshape((NZ,NY,NX))
-    interp_positions[1,0,...] = Z_FWD.reshape((NZ,NY,NX))
-    interp_positions[1,1,...] = R_FWD.reshape((NZ,NY,NX))
-    interp_positions[1,2,...] = 1-interp_positions[0,2,...]
+    R_FWD,R_BWD = R_all[:N],R_all[N:]
+    Z_FWD,Z_BWD = Z_all[:N],Z_all[N:]
+    s_FWD,s_BWD = s_all[:N],s_all[N:]
 
-    return interp_positions
+    return _pack_interp_positions(Z_BWD,R_BWD,s_BWD,Z_FWD,R_FWD,s_FWD,(NZ,NY,NX))
     
 
 def find_interp_positions_v1(my_xgc):
@@ -315,12 +288,18 @@ def find_interp_positions_v1(my_xgc):
     prevnode = my_xgc.prevnode
 
     prevplane,nextplane = my_xgc.prevplane,my_xgc.nextplane
-    dPHI = 2*np.pi / my_xgc.n_plane
-    phi_planes = np.arange(my_xgc.n_plane)*dPHI
+    dPHI = my_xgc.dPHI
+    phi_planes = my_xgc.phi_planes
     
     interp_positions = np.zeros((2,3,NZ,NY,NX))
    
-    psi_want = griddata(my_xgc.points,my_xgc.psi,(Zwant,Rwant),method = 'cubic',fill_value = -1)
+    # reuse the cubic interpolator already built on the XGC triangulation, instead of re-triangulating the mesh in griddata. Outside points are masked, flag them with -1.
+    psi_want = my_xgc.psi_interp(Zwant,Rwant).filled(-1)
+
+    #Calculate the portion of toroidal angle between interpolation planes for all the points at once. Plane 0 is taken at 2pi when the point is more than dPHI away from 0.
+    portion_p_all = np.where((prevplane != 0) | (PHIwant <= dPHI), np.abs(PHIwant - phi_planes[prevplane])/dPHI, np.abs(PHIwant - 2*np.pi)/dPHI)
+    portion_n_all = np.where((nextplane != 0) | (PHIwant <= dPHI), np.abs(PHIwant - phi_planes[nextplane])/dPHI, np.abs(PHIwant - 2*np.pi)/dPHI)
+
     for i in range(NZ):
         for j in range(NY):
             for k in range(NX):
@@ -347,20 +326,8 @@ def find_interp_positions_v1(my_xgc):
                     else:
                         INNER_ONLY = True
 
-                    #Calculate the portion of toroidal angle between interpolation planes
-                    prevp = prevplane[i,j,k]
-                    nextp = nextplane[i,j,k]
-                   
-                    phi = my_xgc.grid.phi3D[i,j,k]
-                    if(prevp != 0 or phi <= dPHI):
-                        portion_p = abs(phi-phi_planes[prevp])/dPHI
-                    else:
-                        portion_p = abs(phi - 2*np.pi)/dPHI
-                        
-                    if(nextp != 0 or phi <= dPHI):    
-                        portion_n = abs(phi-phi_planes[nextp])/dPHI
-                    else:
-                        portion_n = abs(phi - 2*np.pi)/dPHI
+                    portion_p = portion_p_all[i,j,k]
+                    portion_n = portion_n_all[i,j,k]
 
                     #Calculate the expected r,z positions on next and previous planes
                     #first try, use the inner nearest point alone
@@ -402,6 +369,164 @@ def find_interp_positions_v1(my_xgc):
     return interp_positions
 
 
+def _imap(func,tasks,multiprocessing = False,ordered = True,chunksize = 1):
+    """Lazily map *func* over the iterable *tasks*, yielding the results.
+
+    If *multiprocessing* is True, tasks are sent to a pool of processes as workers become free, otherwise they are done one by one in this process. In both cases tasks are only generated when needed, so a generator of large tasks is never turned into a full list. If *ordered* is False, results of the pool are yielded in the order they finish.
+    """
+    if not multiprocessing:
+        for task in tasks:
+            yield func(task)
+        return
+    with mp.Pool() as p:
+        if ordered:
+            results = p.imap(func,tasks,chunksize)
+        else:
+            results = p.imap_unordered(func,tasks,chunksize)
+        for result in results:
+            yield result
+
+def _clough_tocher_on_grid(args):
+    """Clough-Tocher interpolation of values given on a Delaunay triangulation onto given points.
+
+    Module level function taking a single tuple, so that it can be sent to a multiprocessing Pool.
+    :param args: (delaunay, values, points), values has shape (n_mesh, ...), points has shape (..., 2)
+    :return: interpolated values, 0 outside of the convex hull of the triangulation
+    """
+    delaunay,values,points = args
+    return CloughTocher2DInterpolator(delaunay,values,fill_value = 0)(points)
+
+def _write_fluc_cdf_3D(args):
+    """Write one 3D fluctuation file for FWR3D.
+
+    Module level function taking a single tuple, so that it can be sent to a multiprocessing Pool.
+    :param args: (fname, X1D, Y1D, Z1D, dne), dne has shape (len(Z1D), len(Y1D), len(X1D)), and is written in its own precision
+    """
+    fname,X1D,Y1D,Z1D,dne_data = args
+    f = nc.netcdf_file(fname,'w')
+    f.createDimension('nx',len(X1D))
+    f.createDimension('ny',len(Y1D))
+    f.createDimension('nz',len(Z1D))
+
+    xx = f.createVariable('xx','d',('nx',))
+    xx[:] = X1D[:]
+    yy = f.createVariable('yy','d',('ny',))
+    yy[:] = Y1D[:]
+    zz = f.createVariable('zz','d',('nz',))
+    zz[:] = Z1D[:]            
+    xx.units = yy.units = zz.units = 'm'
+
+    dne = f.createVariable('dne',dne_data.dtype.char,('nz','ny','nx'))
+    dne.units = 'm^-3'
+    dne[:,:,:] = dne_data
+    f.close()
+
+def _sum_of_squares(*components):
+    """Sum of the squares of the given arrays, e.g. the squared magnitude of a vector field.
+
+    The squares are accumulated in place, so only the result and one temporary array are allocated, no matter how many components are given.
+    :param components: arrays of the same shape
+    :return: new array, components[0]**2 + components[1]**2 + ...
+    """
+    total = np.square(components[0])
+    tmp = np.empty_like(total)
+    for c in components[1:]:
+        np.square(c,out = tmp)
+        total += tmp
+    return total
+
+def _extrapolate_outside(interp,Zn,Rn,dZ,dR):
+    """Linear extrapolation from the nearest boundary vertices to the outside points.
+
+    :param interp: triangular interpolator with a gradient method, e.g. :py:class:`matplotlib.tri.CubicTriInterpolator`
+    :param Zn,Rn: coordinates of the nearest boundary vertex for each outside point
+    :param dZ,dR: displacement of the outside points from their nearest vertex
+    :return: a_n + dZ * da/dZ + dR * da/dR evaluated at the nearest vertices
+    """
+    a_n = interp(Zn,Rn)
+    grad_Z,grad_R = interp.gradient(Zn,Rn)
+    return a_n + dZ*grad_Z + dR*grad_R
+
+def _back_interpolator(Z1D,R1D,data):
+    """Cubic spline interpolator of on-grid data, used to interpolate back to the original mesh points.
+
+    On a uniform grid, the cubic B-spline coefficients are calculated by :py:func:`scipy.ndimage.spline_filter` and evaluated by :py:func:`scipy.ndimage.map_coordinates` in index space. This is much faster than fitting a :py:class:`scipy.interpolate.RectBivariateSpline`, but the boundary conditions are different: ndimage uses mirror boundary conditions, while FITPACK places the knots so that the spline is not-a-knot like at the edges. The difference is largest at the edges, about 1% of the data amplitude on a smooth field, and decays by roughly a factor of 4 per grid cell towards the inside of the grid.
+    If the grid is not uniform, RectBivariateSpline is used.
+    :param Z1D,R1D: 1D coordinates of the grid
+    :param data: on-grid data, shape (len(Z1D),len(R1D))
+    :return: function f(Z,R) that returns the interpolated values at the points (Z,R)
+    """
+    dZ = (Z1D[-1]-Z1D[0])/(len(Z1D)-1)
+    dR = (R1D[-1]-R1D[0])/(len(R1D)-1)
+    if not (np.allclose(np.diff(Z1D),dZ,rtol = 1e-6,atol = 0) and np.allclose(np.diff(R1D),dR,rtol = 1e-6,atol = 0)):
+        spline = RectBivariateSpline(Z1D,R1D,data)
+        return lambda Z,R: spline(Z,R,grid = False)
+    coeff = spline_filter(data,order = 3,mode = 'mirror')
+    return lambda Z,R: map_coordinates(coeff,np.array([(Z-Z1D[0])/dZ,(R-R1D[0])/dR]),order = 3,mode = 'mirror',prefilter = False)
+
+_decompress_pool = None
+_decompress_pool_pid = None
+
+def _get_decompress_pool():
+    """The thread pool used by :py:func:`_read_deflate_chunks`, created on first use and shared by all later reads.
+
+    A forked child process doesn't inherit the threads of the pool, so a new pool is created if the process has changed.
+    """
+    global _decompress_pool,_decompress_pool_pid
+    if _decompress_pool is None or _decompress_pool_pid != os.getpid():
+        _decompress_pool = ThreadPool(mp.cpu_count())
+        _decompress_pool_pid = os.getpid()
+    return _decompress_pool
+
+def _close_decompress_pool():
+    """Shut down the thread pool of :py:func:`_read_deflate_chunks`, if this process has one. A new one is created by the next read.
+    """
+    global _decompress_pool,_decompress_pool_pid
+    if _decompress_pool is not None and _decompress_pool_pid == os.getpid():
+        _decompress_pool.close()
+        _decompress_pool.join()
+    _decompress_pool = None
+    _decompress_pool_pid = None
+
+atexit.register(_close_decompress_pool)
+
+def _read_deflate_chunks(dataset,out):
+    """Read a gzip compressed, chunked HDF5 dataset with the chunks decompressed in parallel.
+
+    HDF5 runs its filter pipeline serially. Here each thread of a pool reads one raw chunk with read_direct_chunk, decompresses it with zlib, which releases the GIL while working, and copies it into *out* before taking the next chunk. So only one chunk per thread is held in memory besides *out*. Only datasets with deflate as their single filter are handled.
+    :param dataset: h5py Dataset
+    :param out: array with the same shape as dataset, the data is written into it
+    :return: True if the dataset has been read, False if it is not suitable and should be read in the normal way
+    """
+    if (dataset.chunks is None or dataset.compression != 'gzip' or dataset.id.get_create_plist().get_nfilters() != 1
+        or not hasattr(dataset.id,'read_direct_chunk')):
+        return False
+    chunks = dataset.chunks
+    offsets = itertools.product(*[range(0,n,c) for n,c in zip(dataset.shape,chunks)])
+    def read_chunk(offset):
+        filter_mask,data = dataset.id.read_direct_chunk(offset)
+        # filter_mask bit 0 set means deflate was skipped for this chunk
+        if not filter_mask & 1:
+            data = zlib.decompress(data)
+        # edge chunks are stored at full size, only the part inside the dataset is copied. Chunks don't overlap, so the threads write to different parts of out.
+        block = np.frombuffer(data,dtype = dataset.dtype).reshape(chunks)
+        region = tuple(slice(o,min(o+c,n)) for o,c,n in zip(offset,chunks,dataset.shape))
+        out[region] = block[tuple(slice(0,r.stop-r.start) for r in region)]
+    for _ in _get_decompress_pool().imap_unordered(read_chunk,offsets):
+        pass
+    return True
+
+def _read_prf(fname):
+    """Read a two column XGC profile file (*.prf).
+
+    The first line (number of points) and the last data line (end flag) are skipped, the same as np.genfromtxt(fname,skip_header = 1,skip_footer = 1), but the numbers are parsed by the C reader of np.loadtxt.
+    :return: the two columns, (psi, value)
+    """
+    with open(fname) as f:
+        lines = f.read().splitlines()[1:]
+    rows = [l for l in lines if l.strip()][:-1]
+    return np.loadtxt(rows,unpack = True)
+
 class XGC_Loader_Error(Exception):
     def __init__(self,value):
         self.value = value
@@ -414,7 +539,7 @@ class XGC_Loader():
     """
 
     def __init__(self,xgc_path,grid,time_steps,dn_amplifier = 1.0, n_cross_section = 1,equilibrium_mesh = '2D',Equilibrium_Only = False,Full_Load = True, Fluc_Only = True,Fluc_Filtering = False,
-                 load_ions = False):
+                 load_ions = False, multiprocessing = False, fluc_dtype = np.float64, tracer_dtype = np.float64):
         """The main caller of all functions to prepare a loaded XGC profile.
 
             :param string xgc_path: the directory of all the XGC output files
@@ -428,6 +553,9 @@ class XGC_Loader():
             :param boolean Full_Load: A flag for debugging, default to be True, i.e. load all data when initializing, if set to be False, then only constants are set, no loading functions will be called during initialization, programmer can call them one by one afterwards.
             :param boolean Fluc_Only: A flag determining fluctuation loading method. Default to be True. Fluc_Only == True uses newer loading method to remove equilibrium relaxation effects. Fluc_Only == False uses old version and load all the calculated density deviations from the equilibrium.
             :param boolean Fluc_Filtering: A flag determining whether filter out the fluctuations that are larger than background equilibrium. If True, fluctuations will be filtered. Default to be False.
+            :param boolean multiprocessing: Choice between the serial code and the parallel one. If True, the 2D interpolation of different cross-sections, the 3D interpolation on different toroidal planes, and the writing of 3D fluctuation files, are done in a pool of processes. Default to be False.
+            :param fluc_dtype: floating point type used to read and store the fluctuation arrays (phi, nane, dni and dne_ad), their interpolations on grid, and the dne variables in the output cdf files. np.float32 halves their memory, bandwidth and file size, default to be np.float64. Means and toroidal averages are always accumulated in double precision, and equilibrium quantities are always kept in double precision. Use interp_check to see the effect on the accuracy.
+            :param tracer_dtype: floating point type of the traced R,Z positions in the 3D field line tracing, see :py:func:`find_interp_positions_v2_upgrade`. np.float32 halves the memory of the tracing arrays, default to be np.float64. Compare the interpolation positions with both choices to validate single precision tracing.
         """
 
         print('Loading XGC output data')
@@ -448,6 +576,11 @@ class XGC_Loader():
         self.Equilibrium_Only = Equilibrium_Only
         self.Fluc_Only = Fluc_Only
         self.Fluc_Filtering = Fluc_Filtering
+        self.multiprocessing = multiprocessing
+        self.fluc_dtype = fluc_dtype
+        self.tracer_dtype = tracer_dtype
+        self._fluc_buffers = {} # read buffers for the fluctuation files, reused by all loadings, see _read_fluc_step
+        self._check_splines = {} # back interpolators used by interp_check, see _back_interpolator, keyed by (toroidal_cross,time)
         
         print('from directory:'+ self.xgc_path)
         self.unit_dic = load_m(self.unit_file)
@@ -641,14 +774,12 @@ class XGC_Loader():
         self.trifinder =  DelaunayTriFinder(self.Delaunay, self.triangulation)
         self.nextnode = mesh['nextnode'][...]
         
-        self.prevnode = np.zeros(self.nextnode.shape)
-        for i in range(len(self.nextnode)):
-            prevnodes = np.nonzero(self.nextnode == i)[0]
-            if( len(prevnodes)>0 ):
-                self.prevnode[i] = prevnodes[0]
-            else:
-                self.prevnode[i] = -1
-        
+        # invert the nextnode map, if several nodes point to the same node, the first one is kept. Nodes not pointed to by any other node get -1.
+        self.prevnode = np.full(self.nextnode.shape, -1, dtype=int)
+        targets,first_idx = np.unique(self.nextnode, return_index = True)
+        valid = (targets >= 0) & (targets < len(self.nextnode))
+        self.prevnode[targets[valid]] = first_idx[valid]
+
         self.psi = np.copy(mesh['psi'][...])
         self.psi_interp = cubic_interp(self.triangulation, self.psi,  trifinder = self.trifinder)
 
@@ -658,6 +789,9 @@ class XGC_Loader():
         fluc_file0 = self.xgc_path + 'xgc.3d.' + str(self.time_steps[0]).zfill(5)+'.h5'
         fmesh = h5.File(fluc_file0,'r')
         self.n_plane = fmesh['dpot'].shape[1]
+        # toroidal spacing and angles of the planes, shared by all the field line tracing routines
+        self.dPHI = 2*np.pi/self.n_plane
+        self.phi_planes = np.arange(self.n_plane)*self.dPHI
 
         fmesh.close()
         
@@ -672,7 +806,7 @@ class XGC_Loader():
         """
         B_mesh = h5.File(self.bfield_file,'r')
         self.B = np.copy(B_mesh['node_data[0]']['values'])
-        self.B_total = np.sqrt(self.B[:,0]**2 + self.B[:,1]**2 + self.B[:,2]**2)
+        self.B_total = np.sqrt(_sum_of_squares(self.B[:,0],self.B[:,1],self.B[:,2]))
         self.B_interp = cubic_interp(self.triangulation, self.B_total, trifinder = self.trifinder) 
         B_mesh.close()
         return 0
@@ -691,7 +825,8 @@ class XGC_Loader():
         self.BR_interp = cubic_interp(self.triangulation, self.BR, trifinder = self.trifinder) # outside points will be masked, deal with them later in interpolation function
         self.BZ_interp = cubic_interp(self.triangulation, self.BZ, trifinder = self.trifinder)
         self.BPhi_interp = cubic_interp(self.triangulation, self.BPhi, trifinder = self.trifinder)
-
+        # all three components at once, used in field line tracing
+        self.Bvec_interp = MultiTriInterpolator([self.BR_interp,self.BZ_interp,self.BPhi_interp], self.trifinder)
         
         B_mesh.close()
 
@@ -699,6 +834,39 @@ class XGC_Loader():
         self.CO_DIR = (np.sign(self.BPhi[0]) > 0)
         return 0
 
+    def _read_fluc_step(self,i):
+        """Read the fluctuation datasets of the i-th chosen time step.
+
+        The file is opened and closed here, each dataset is read only once.
+        Whole datasets are read on purpose: every loader needs all the toroidal planes, either for the per-step mean (phi_bar etc.) or for the toroidal average, so selecting only the chosen planes in HDF5 would not save any I/O.
+        The data is read directly into self.fluc_dtype buffers kept in self._fluc_buffers, which are reused by all later calls, also across loader invocations, as long as the shape and dtype match. The returned arrays are therefore overwritten by the next call, copy them if they need to be kept.
+        :return: dpot, eden, iden arrays with shape (n_mesh, n_plane). eden is None if self.HaveElectron is False, and iden is None if self.load_ions is False.
+        """
+        flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[i]).zfill(5)+'.h5'
+        fluc_mesh = h5.File(flucf,'r')
+        names = ('dpot','eden' if self.HaveElectron else None,'iden' if self.load_ions else None)
+        data = []
+        for name in names:
+            if name is None:
+                data.append(None)
+            else:
+                buf = self._fluc_buffers.get(name)
+                if buf is None or buf.shape != fluc_mesh[name].shape or buf.dtype != self.fluc_dtype:
+                    buf = np.empty(fluc_mesh[name].shape,dtype = self.fluc_dtype)
+                    self._fluc_buffers[name] = buf
+                # compressed datasets are decompressed in parallel if possible, otherwise HDF5 reads the data and converts it to the buffer's dtype
+                if not _read_deflate_chunks(fluc_mesh[name],buf):
+                    fluc_mesh[name].read_direct(buf)
+                data.append(buf)
+        fluc_mesh.close()
+        return tuple(data)
+
+    def clear_buffers(self):
+        """Release the read buffers kept between fluctuation loadings, e.g. when memory is needed elsewhere, and shut down the decompression threads. They will be created again on the next loading.
+        """
+        self._fluc_buffers = {}
+        _close_decompress_pool()
+
     def load_fluctuations_2D_all(self):
         """Load non-adiabatic electron density and electrical static potential fluctuations
         the mean value of these two quantities on each time step is also calculated.
@@ -707,38 +875,33 @@ class XGC_Loader():
 
         """
         if(self.HaveElectron):
-            self.nane = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.mesh['R'])) )
+            self.nane = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.mesh['R'])),dtype = self.fluc_dtype)
             self.nane_bar = np.zeros((len(self.time_steps)))
         if(self.load_ions):
-            self.dni = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.mesh['R'])) )
+            self.dni = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.mesh['R'])),dtype = self.fluc_dtype)
             self.dni_bar = np.zeros((len(self.time_steps)))
             
-        self.phi = np.zeros((self.n_cross_section,len(self.time_steps),len(self.mesh['R'])))
+        self.phi = np.zeros((self.n_cross_section,len(self.time_steps),len(self.mesh['R'])),dtype = self.fluc_dtype)
         self.phi_bar = np.zeros((len(self.time_steps)))
         for i in range(len(self.time_steps)):
-            flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[i]).zfill(5)+'.h5'
-            fluc_mesh = h5.File(flucf,'r')
+            # each dataset is read only once per file, all the cross-sections are taken from the in-memory copy. The read buffers are reused for every step.
+            dpot_all,eden_all,iden_all = self._read_fluc_step(i)
             if (i == 0):
-                self.n_plane = fluc_mesh['dpot'].shape[1]
+                self.n_plane = dpot_all.shape[1]
                 dn = int(self.n_plane/self.n_cross_section)
                 self.planes = np.arange(self.n_cross_section) * dn
 
-            self.phi_bar[i] = np.mean(fluc_mesh['dpot'][...])                
+            self.phi_bar[i] = np.mean(dpot_all,dtype = np.float64)
             if(self.HaveElectron):
-                self.nane_bar[i] = np.mean(fluc_mesh['eden'][...])
+                self.nane_bar[i] = np.mean(eden_all,dtype = np.float64)
             if(self.load_ions):
-                self.dni_bar[i] = np.mean(fluc_mesh['iden'][...])
-            for j in range(self.n_cross_section):
-                self.phi[j,i] += np.swapaxes(fluc_mesh['dpot'][...][:,self.planes[j]],0,1)
-                self.phi[j,i] -= self.phi_bar[i]
-
-                if(self.HaveElectron):
-                    self.nane[j,i] += np.swapaxes(fluc_mesh['eden'][...][:,self.planes[j]],0,1)
-                    self.nane[j,i] -= self.nane_bar[i]
-                if(self.load_ions):
-                    self.dni[j,i] += np.swapaxes(fluc_mesh['iden'][...][:,self.planes[j]],0,1)
-                    self.dni[j,i] -= self.dni_bar[i]
-            fluc_mesh.close()
+                self.dni_bar[i] = np.mean(iden_all,dtype = np.float64)
+            # all the chosen cross-sections are picked and shifted at once
+            self.phi[:,i] = dpot_all[:,self.planes].T - self.phi_bar[i]
+            if(self.HaveElectron):
+                self.nane[:,i] = eden_all[:,self.planes].T - self.nane_bar[i]
+            if(self.load_ions):
+                self.dni[:,i] = iden_all[:,self.planes].T - self.dni_bar[i]
 
 
         
@@ -763,42 +926,32 @@ class XGC_Loader():
         where n0 is the input equilibrium, and <...>_zeta_t denotes average over both toroidal and time.
         """
         #first we load one file to obtain the total plane number used in the simulation
-        flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[0]).zfill(5)+'.h5'
-        fluc_mesh = h5.File(flucf,'r')        
-        self.n_plane = fluc_mesh['dpot'].shape[1]
+        dpot,eden,iden = self._read_fluc_step(0)
+        self.n_plane = dpot.shape[1]
         dn = int(self.n_plane/self.n_cross_section)#dn is the increment between two chosen cross-sections, if total chosen number is greater than total simulation plane number, an error will occur.
         self.planes = np.arange(self.n_cross_section)*dn
 
         if(self.HaveElectron):
-            self.nane = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.mesh['R'])))
-            nane_all = np.zeros( (self.n_plane, len(self.time_steps), len(self.mesh['R']) ) )
+            self.nane = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.mesh['R'])),dtype = self.fluc_dtype)
+            nane_avg_tor = np.zeros( (len(self.time_steps), len(self.mesh['R']) ) )
         if(self.load_ions):
-            self.dni = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.mesh['R'])))
-            dni_all = np.zeros( (self.n_plane, len(self.time_steps), len(self.mesh['R']) ) )
-        self.phi = np.zeros((self.n_cross_section,len(self.time_steps),len(self.mesh['R'])))
-        phi_all = np.zeros((self.n_plane,len(self.time_steps),len(self.mesh['R'])))
-
-        #after initializing the arrays to hold the data, we load the data from the first chosen step
-        for j in range(self.n_plane):
-            phi_all[j,0] += np.swapaxes(fluc_mesh['dpot'][...][:,j],0,1)
+            self.dni = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.mesh['R'])),dtype = self.fluc_dtype)
+            dni_avg_tor = np.zeros( (len(self.time_steps), len(self.mesh['R']) ) )
+        self.phi = np.zeros((self.n_cross_section,len(self.time_steps),len(self.mesh['R'])),dtype = self.fluc_dtype)
+        phi_avg_tor = np.zeros((len(self.time_steps),len(self.mesh['R'])))
+
+        #after initializing the arrays to hold the data, we store the data from the first chosen step, and load all the data from rest of the chosen time steps. Only the chosen cross-sections are kept, the toroidal average over all planes is taken while the whole step is in memory.
+        for i in range(len(self.time_steps)):
+            if (i > 0):
+                dpot,eden,iden = self._read_fluc_step(i)
+            self.phi[:,i] = dpot[:,self.planes].T
+            phi_avg_tor[i] = np.mean(dpot,axis = 1,dtype = np.float64)
             if(self.HaveElectron):
-                nane_all[j,0] += np.swapaxes(fluc_mesh['eden'][...][:,j],0,1)
+                self.nane[:,i] = eden[:,self.planes].T
+                nane_avg_tor[i] = np.mean(eden,axis = 1,dtype = np.float64)
             if(self.load_ions):
-                dni_all[j,0] += np.swapaxes(fluc_mesh['iden'][...][:,j],0,1)
-        fluc_mesh.close()
-        
-        for i in range(1,len(self.time_steps)):
-            #now we load all the data from rest of the chosen time steps. 
-            flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[i]).zfill(5)+'.h5'
-            fluc_mesh = h5.File(flucf,'r')
-                
-            for j in range(self.n_plane):
-                phi_all[j,i] += np.swapaxes(fluc_mesh['dpot'][...][:,j],0,1)
-                if(self.HaveElectron):
-                    nane_all[j,i] += np.swapaxes(fluc_mesh['eden'][...][:,j],0,1)
-                if(self.load_ions):
-                    dni_all[j,i] += np.swapaxes(fluc_mesh['iden'][...][:,j],0,1)
-            fluc_mesh.close()
+                self.dni[:,i] = iden[:,self.planes].T
+                dni_avg_tor[i] = np.mean(iden,axis = 1,dtype = np.float64)
 
 
 
@@ -809,24 +962,20 @@ class XGC_Loader():
         #   n0_eff = n0 + <delta_n>_zeta_t , where n0 is the input equilibrium, and <...>_zeta_t denotes average over both toroidal and time.
 
         # first, we calculate the n_tilde, note that we have adiabatic and non-adiabatic parts. The adiabatic part is given by the potential, and will be calculated later in calc_total_ne_2D3D.
-        phi_avg_tor = np.average(phi_all,axis = 0)
+        self.phi -= phi_avg_tor[np.newaxis,:,:]
         if(self.HaveElectron):
-            nane_avg_tor = np.average(nane_all,axis=0)
+            self.nane -= nane_avg_tor[np.newaxis,:,:]
         if(self.load_ions):
-            dni_avg_tor = np.average(dni_all,axis=0)
-        for j in range(self.n_cross_section):
-            self.phi[j,:,:] = phi_all[self.planes[j],:,:] - phi_avg_tor[:,:]
-            if(self.HaveElectron):
-                self.nane[j,:,:] = nane_all[self.planes[j],:,:] - nane_avg_tor[:,:]
-            if(self.load_ions):
-                self.dni[j,:,:] = dni_all[self.planes[j],:,:] - dni_avg_tor[:,:]
+            self.dni -= dni_avg_tor[np.newaxis,:,:]
 
         # then, we add the averaged relaxation modification to the input equilibrium
 
-        self.ne0[:] += np.average(phi_avg_tor,axis = 0)
+        # the potential part is the same for electrons and ions, average it over time only once
+        phi_avg_tor_t = np.average(phi_avg_tor,axis = 0)
+        self.ne0[:] += phi_avg_tor_t
         if(self.HaveElectron):
             self.ne0[:] += np.average(nane_avg_tor,axis = 0)
-        self.ni0[:] += np.average(phi_avg_tor,axis = 0)
+        self.ni0[:] += phi_avg_tor_t
         if(self.load_ions):
             self.ni0[:] += np.average(dni_avg_tor,axis = 0)
         
@@ -840,47 +989,41 @@ class XGC_Loader():
         the mean value of these two quantities on each time step is also calculated.
         for multiple cross-section runs, data is stored under each center_plane index.
         """
-        #similar to the 2D case, we first read one file to determine the total toroidal plane number in the simulation
-        flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[0]).zfill(5)+'.h5'
-        fluc_mesh = h5.File(flucf,'r')
-
         self.planes = np.unique(np.array([np.unique(self.prevplane),np.unique(self.nextplane)]))
         self.planeID = {self.planes[i]:i for i in range(len(self.planes))} #the dictionary contains the positions of each chosen plane, useful when we want to get the data on a given plane known only its plane number in xgc file.
         if(self.HaveElectron):
-            self.nane = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])) )
+            self.nane = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])),dtype = self.fluc_dtype)
             self.nane_bar = np.zeros((len(self.time_steps)))
 
         if(self.load_ions):
-            self.dni = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])) )
+            self.dni = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])),dtype = self.fluc_dtype)
             self.dni_bar = np.zeros((len(self.time_steps)))
 
-        self.phi = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])) )
+        self.phi = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])),dtype = self.fluc_dtype)
         self.phi_bar = np.zeros((len(self.time_steps)))
-        for i in range(len(self.time_steps)):
-            flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[i]).zfill(5)+'.h5'
-            fluc_mesh = h5.File(flucf,'r')
 
-            if(i==0):
-                #self.n_plane = fluc_mesh['dpot'].shape[1]
-                dn = int(self.n_plane/self.n_cross_section)
-                self.center_planes = np.arange(self.n_cross_section)*dn
+        # n_plane is already known from the 3D mesh loading
+        dn = int(self.n_plane/self.n_cross_section)
+        self.center_planes = np.arange(self.n_cross_section)*dn
+        # plane indices needed for every cross-section, shape (n_cross_section, len(self.planes)), computed once for all time steps
+        self.plane_idx = ((self.center_planes[:,np.newaxis] + self.planes[np.newaxis,:])%self.n_plane).astype(np.intp)
+
+        for i in range(len(self.time_steps)):
+            # each dataset is read only once per file, all the cross-sections are taken from the in-memory copy. The read buffers are reused for every step.
+            dpot_all,eden_all,iden_all = self._read_fluc_step(i)
 
-            self.phi_bar[i] = np.mean(fluc_mesh['dpot'][...])
+            self.phi_bar[i] = np.mean(dpot_all,dtype = np.float64)
             if (self.HaveElectron):
-                self.nane_bar[i] = np.mean(fluc_mesh['eden'][...])
+                self.nane_bar[i] = np.mean(eden_all,dtype = np.float64)
             if (self.load_ions):
-                self.dni_bar[i] = np.mean(fluc_mesh['iden'][...])
+                self.dni_bar[i] = np.mean(iden_all,dtype = np.float64)
                 
-            for j in range(self.n_cross_section):
-                self.phi[j,i] += np.swapaxes(fluc_mesh['dpot'][...][:,(self.center_planes[j] + self.planes)%self.n_plane],0,1)
-                self.phi[j,i] -= self.phi_bar[i]
-                if(self.HaveElectron):
-                    self.nane[j,i] += np.swapaxes(fluc_mesh['eden'][...][:,(self.center_planes[j] + self.planes)%self.n_plane],0,1)
-                    self.nane[j,i] -= self.nane_bar[i]
-                if(self.load_ions):
-                    self.dni[j,i] += np.swapaxes(fluc_mesh['iden'][...][:,(self.center_planes[j] + self.planes)%self.n_plane],0,1)
-                    self.dni[j,i] -= self.dni_bar[i]
-            fluc_mesh.close()
+            # mesh index moved to the last axis, giving (n_cross_section, len(self.planes), n_mesh)
+            self.phi[:,i] = np.moveaxis(dpot_all[:,self.plane_idx],0,-1) - self.phi_bar[i]
+            if(self.HaveElectron):
+                self.nane[:,i] = np.moveaxis(eden_all[:,self.plane_idx],0,-1) - self.nane_bar[i]
+            if(self.load_ions):
+                self.dni[:,i] = np.moveaxis(iden_all[:,self.plane_idx],0,-1) - self.dni_bar[i]
             
         return 0
 
@@ -893,58 +1036,55 @@ class XGC_Loader():
         for multiple cross-section runs, data is stored under each center_plane index.
         """
         #similar to the 2D case, we first read one file to determine the total toroidal plane number in the simulation
-        flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[0]).zfill(5)+'.h5'
-        fluc_mesh = h5.File(flucf,'r')
+        dpot,eden,iden = self._read_fluc_step(0)
 
-        self.n_plane = fluc_mesh['dpot'].shape[1]
+        self.n_plane = dpot.shape[1]
         dn = int(self.n_plane/self.n_cross_section)
         self.center_planes = np.arange(self.n_cross_section)*dn
 
         self.planes = np.unique(np.array([np.unique(self.prevplane),np.unique(self.nextplane)]))
         self.planeID = {self.planes[i]:i for i in range(len(self.planes))} #the dictionary contains the positions of each chosen plane, useful when we want to get the data on a given plane known only its plane number in xgc file.
+        # plane indices needed for every cross-section, shape (n_cross_section, len(self.planes)), computed once for all time steps
+        self.plane_idx = ((self.center_planes[:,np.newaxis] + self.planes[np.newaxis,:])%self.n_plane).astype(np.intp)
 
         #initialize the arrays
         if(self.HaveElectron):
-            self.nane = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])) )
-            nane_all = np.zeros((self.n_plane,len(self.time_steps),len(self.mesh['R'])))
+            self.nane = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])),dtype = self.fluc_dtype)
+            nane_avg_tor = np.zeros((len(self.time_steps),len(self.mesh['R'])))
         if(self.load_ions):
-            self.dni = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])) )
-            dni_all = np.zeros((self.n_plane,len(self.time_steps),len(self.mesh['R'])))
-        self.phi = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])) )
-        phi_all = np.zeros((self.n_plane,len(self.time_steps),len(self.mesh['R'])))
-
-        #load all the rest of the files
-        for i in range(1,len(self.time_steps)):
-            flucf = self.xgc_path + 'xgc.3d.'+str(self.time_steps[i]).zfill(5)+'.h5'
-            fluc_mesh = h5.File(flucf,'r')
-            for j in range(self.n_plane):
-                phi_all[j,i] += np.swapaxes(fluc_mesh['dpot'][...][:,j],0,1)
-                if(self.HaveElectron):
-                    nane_all[j,i] += np.swapaxes(fluc_mesh['eden'][...][:,j],0,1)
-                if(self.load_ions):
-                    dni_all[j,i] += np.swapaxes(fluc_mesh['iden'][...][:,j],0,1)
-            fluc_mesh.close()
+            self.dni = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])),dtype = self.fluc_dtype)
+            dni_avg_tor = np.zeros((len(self.time_steps),len(self.mesh['R'])))
+        self.phi = np.zeros( (self.n_cross_section,len(self.time_steps),len(self.planes),len(self.mesh['R'])),dtype = self.fluc_dtype)
+        phi_avg_tor = np.zeros((len(self.time_steps),len(self.mesh['R'])))
+
+        #store the data from the first chosen step, which is already read, and load all the rest of the files. Only the needed planes are kept, with the mesh index moved to the last axis, the toroidal average over all planes is taken while the whole step is in memory.
+        for i in range(len(self.time_steps)):
+            if (i > 0):
+                dpot,eden,iden = self._read_fluc_step(i)
+            self.phi[:,i] = np.moveaxis(dpot[:,self.plane_idx],0,-1)
+            phi_avg_tor[i] = np.mean(dpot,axis = 1,dtype = np.float64)
+            if(self.HaveElectron):
+                self.nane[:,i] = np.moveaxis(eden[:,self.plane_idx],0,-1)
+                nane_avg_tor[i] = np.mean(eden,axis = 1,dtype = np.float64)
+            if(self.load_ions):
+                self.dni[:,i] = np.moveaxis(iden[:,self.plane_idx],0,-1)
+                dni_avg_tor[i] = np.mean(iden,axis = 1,dtype = np.float64)
 
 
         #similar to the 2D case, we take care of the equilibrium relaxation contribution. See details in the comments in 2D loading function.
         
-        phi_avg_tor = np.average(phi_all,axis = 0)
+        self.phi -= phi_avg_tor[np.newaxis,:,np.newaxis,:]
         if self.HaveElectron:
-            nane_avg_tor = np.average(nane_all,axis=0)
+            self.nane -= nane_avg_tor[np.newaxis,:,np.newaxis,:]
         if self.load_ions:
-            dni_avg_tor = np.average(dni_all,axis=0)
-
-        for j in range(self.n_cross_section):
-            self.phi[j,...] = np.swapaxes(phi_all[(self.center_planes[j] + self.planes)%self.n_plane,:,:],0,1) - phi_avg_tor[:,np.newaxis,:]
-            if self.HaveElectron:
-                self.nane[j,...] = np.swapaxes(nane_all[(self.center_planes[j] + self.planes)%self.n_plane,:,:],0,1) - nane_avg_tor[:,np.newaxis,:]
-            if self.load_ions:
-                self.dni[j,...] = np.swapaxes(dni_all[(self.center_planes[j] + self.planes)%self.n_plane,:,:],0,1) - dni_avg_tor[:,np.newaxis,:]
+            self.dni -= dni_avg_tor[np.newaxis,:,np.newaxis,:]
 
-        self.ne0[:] += np.average(phi_avg_tor,axis=0)
+        # the potential part is the same for electrons and ions, average it over time only once
+        phi_avg_tor_t = np.average(phi_avg_tor,axis=0)
+        self.ne0[:] += phi_avg_tor_t
         if self.HaveElectron:
             self.ne0[:] += np.average(nane_avg_tor,axis=0)
-        self.ni0[:] += np.average(phi_avg_tor,axis=0)
+        self.ni0[:] += phi_avg_tor_t
         if self.load_ions:
             self.ni0[:] += np.average(dni_avg_tor,axis=0)
             
@@ -997,8 +1137,8 @@ class XGC_Loader():
         te_fname = 'xgc.Te_prof.prf'
         ne_fname = 'xgc.ne_prof.prf'
 
-        psi_te, te = np.genfromtxt(te_fname,skip_header = 1,skip_footer = 1,unpack = True)
-        psi_ne, ne = np.genfromtxt(ne_fname,skip_header = 1,skip_footer = 1,unpack = True)
+        psi_te, te = _read_prf(te_fname)
+        psi_ne, ne = _read_prf(ne_fname)
 
         psi_x = load_m(self.xgc_path + 'units.m')['psi_x']
 
@@ -1016,21 +1156,21 @@ class XGC_Loader():
         ne0 = self.ne0
         te0 = self.te0
         ni0 = self.ni0
-        inner_idx = np.where(te0>0)[0]
-        self.dne_ad = np.zeros(self.phi.shape)
-        self.dne_ad[...,inner_idx] += ne0[inner_idx] * self.phi[...,inner_idx] /self.te0[inner_idx]
+        inner_mask = te0>0
+        # dne_ad = ne0*phi/te0 where te0 > 0, and 0 elsewhere. The ratio ne0/te0 only depends on the mesh point, so it is calculated once, and dne_ad is then obtained by a single broadcast multiplication into the output array.
+        scale = np.divide(ne0,te0,out = np.zeros(te0.shape),where = inner_mask)
+        self.dne_ad = np.zeros(self.phi.shape,dtype = self.phi.dtype)
+        np.multiply(self.phi,scale,out = self.dne_ad,where = inner_mask)
         
         if(self.Fluc_Filtering):
-            ad_invalid_mask = np.absolute(self.dne_ad) > np.absolute(ne0)
-            self.dne_ad[ad_invalid_mask] = 0
+            abs_ne0 = np.absolute(ne0)
+            np.copyto(self.dne_ad,0,where = np.absolute(self.dne_ad) > abs_ne0)
             
             if(self.HaveElectron):
-                na_invalid_mask = np.absolute(self.nane) > np.absolute(ne0)
-                self.nane[na_invalid_mask] = 0
+                np.copyto(self.nane,0,where = np.absolute(self.nane) > abs_ne0)
     
             if(self.load_ions):
-                ni_invalid_mask = np.absolute(self.dni) > np.absolute(ni0)
-                self.dni[ni_invalid_mask] = 0
+                np.copyto(self.dni,0,where = np.absolute(self.dni) > np.absolute(ni0))
             print('density fluctuations filtered.')
 
     def interpolate_all_on_grid_2D(self):
@@ -1048,6 +1188,9 @@ class XGC_Loader():
         R2D = self.grid.R2D
         Z2D = self.grid.Z2D
 
+        #on grid data will change, splines cached by interp_check are not valid anymore
+        self._check_splines = {}
+
         #psi on grid
         self.psi_on_grid = self.psi_interp(Z2D,R2D)
         out_mask = np.copy(self.psi_on_grid.mask)
@@ -1061,31 +1204,21 @@ class XGC_Loader():
         Z_boundary = p_boundary[:,0]
         R_boundary = p_boundary[:,1]
         
-        #Now let's calculate *psi* on outside points, first, get the nearest boundary point for each outside point
-        nearest_indices = []
-        for i in range(len(Zout)):
-            Z = Zout[i]
-            R = Rout[i]
-            nearest_indices.append (np.argmin((Z-Z_boundary)**2 + (R-R_boundary)**2) )
+        #Now let's calculate *psi* on outside points, first, get the nearest boundary point for each outside point. A KD-tree on the boundary vertices finds all of them in one query.
+        nearest_indices = cKDTree(p_boundary).query(np.column_stack([Zout,Rout]))[1]
             
-        # Then, calculate *psi* based on the gradient at these nearest points
+        # Then, calculate *psi* based on the value and gradient at these nearest points, the displacements from them are shared by all the quantities
         Zn = Z_boundary[nearest_indices]
         Rn = R_boundary[nearest_indices]
-        #The value *psi* and its gradiant at this nearest point can by easily obtained            
-        psi_n = self.psi_interp(Zn,Rn)            
-        gradpsi_Z,gradpsi_R = self.psi_interp.gradient(Zn,Rn)
-        
-        psi_out = psi_n + (Zout-Zn)*gradpsi_Z + (Rout-Rn)*gradpsi_R
+        dZ = Zout-Zn
+        dR = Rout-Rn
         
         # Finally, assign these outside values to the original array
-        self.psi_on_grid[out_mask] = psi_out
+        self.psi_on_grid[out_mask] = _extrapolate_outside(self.psi_interp,Zn,Rn,dZ,dR)
 
         #B on grid
         self.B_on_grid = self.B_interp(Z2D,R2D)
-        B_n = self.B_interp(Zn,Rn)
-        gradB_Z, gradB_R = self.B_interp.gradient(Zn,Rn)
-        B_out = B_n + (Zout-Zn)*gradB_Z + (Rout-Rn)*gradB_R
-        self.B_on_grid[out_mask] = B_out
+        self.B_on_grid[out_mask] = _extrapolate_outside(self.B_interp,Zn,Rn,dZ,dR)
                 
         
         
@@ -1096,7 +1229,7 @@ class XGC_Loader():
         self.ni0_on_grid = self.ni0_sp(self.psi_on_grid)        
         
         #fluctuations 
-        self.phi_on_grid = np.zeros((self.n_cross_section,len(self.time_steps),R2D.shape[0],R2D.shape[1]))
+        self.phi_on_grid = np.zeros((self.n_cross_section,len(self.time_steps),R2D.shape[0],R2D.shape[1]),dtype = self.fluc_dtype)
         self.dne_ad_on_grid = np.zeros_like(self.phi_on_grid)
         self.dni_ad_on_grid = np.zeros_like(self.phi_on_grid)
         if self.HaveElectron:
@@ -1106,14 +1239,24 @@ class XGC_Loader():
         
 
 
-        for i in range(self.n_cross_section):
-            for j in range(self.nt):
-                self.phi_on_grid[i,j,...] += CloughTocher2DInterpolator(self.Delaunay,self.phi[i,j,:],fill_value = 0)(np.array([Z2D,R2D]).transpose(1,2,0))
-                self.dne_ad_on_grid[i,j,...] += CloughTocher2DInterpolator(self.Delaunay,self.dne_ad[i,j,:],fill_value = 0)(np.array([Z2D,R2D]).transpose(1,2,0))
-                if(self.HaveElectron):
-                    self.nane_on_grid[i,j,...] += CloughTocher2DInterpolator(self.Delaunay,self.nane[i,j,:],fill_value = 0)(np.array([Z2D,R2D]).transpose(1,2,0))
-                if(self.load_ions):
-                    self.dni_on_grid[i,j,...] += CloughTocher2DInterpolator(self.Delaunay,self.dni[i,j,:],fill_value = 0)(np.array([Z2D,R2D]).transpose(1,2,0))
+        # all the fields and time steps of one cross-section are interpolated by a single CloughTocher2DInterpolator with stacked values, so the grid points are located in self.Delaunay only once. The gradient estimation is still done separately for each value column.
+        grid_points = np.array([Z2D,R2D]).transpose(1,2,0)
+        fields = [self.phi,self.dne_ad]
+        fields_on_grid = [self.phi_on_grid,self.dne_ad_on_grid]
+        if(self.HaveElectron):
+            fields.append(self.nane)
+            fields_on_grid.append(self.nane_on_grid)
+        if(self.load_ions):
+            fields.append(self.dni)
+            fields_on_grid.append(self.dni_on_grid)
+
+        # values have shape (n_mesh, n_fields, nt). Cross-sections are independent, so they can be sent to different processes.
+        # tasks are generated lazily, so only the cross-sections being interpolated have a stacked copy of their values
+        tasks = ((self.Delaunay,np.moveaxis(np.array([f[i,:self.nt,:] for f in fields]),-1,0),grid_points) for i in range(self.n_cross_section))
+        results = _imap(_clough_tocher_on_grid,tasks,self.multiprocessing and self.n_cross_section > 1)
+        for i,interp_values in enumerate(results):
+            for n,f_on_grid in enumerate(fields_on_grid):
+                f_on_grid[i,:self.nt,...] += np.moveaxis(interp_values[...,n,:],-1,0)
 
         self.interp_check() # after the interpolation, check if the perturbations are interpolated within a reasonable error
 
@@ -1167,43 +1310,27 @@ class XGC_Loader():
             Z_boundary = p_boundary[:,0]
             R_boundary = p_boundary[:,1]
             
-            #Now let's calculate *psi* on outside points, first, get the nearest boundary point for each outside point
-            nearest_indices = []
-            for i in range(len(Zout)):
-                Z = Zout[i]
-                R = Rout[i]
-                nearest_indices.append (np.argmin((Z-Z_boundary)**2 + (R-R_boundary)**2) )
+            #Now let's calculate *psi* on outside points, first, get the nearest boundary point for each outside point. A KD-tree on the boundary vertices finds all of them in one query.
+            nearest_indices = cKDTree(p_boundary).query(np.column_stack([Zout,Rout]))[1]
                 
-            # Then, calculate *psi* based on the gradient at these nearest points
+            # Then, calculate *psi* based on the value and gradient at these nearest points, the displacements from them are shared by all the quantities
             Zn = Z_boundary[nearest_indices]
             Rn = R_boundary[nearest_indices]
-            #The value *psi* and its gradiant at this nearest point can by easily obtained            
-            psi_n = self.psi_interp(Zn,Rn)            
-            gradpsi_Z,gradpsi_R = self.psi_interp.gradient(Zn,Rn)
-            
-            psi_out = psi_n + (Zout-Zn)*gradpsi_Z + (Rout-Rn)*gradpsi_R
+            dZ = Zout-Zn
+            dR = Rout-Rn
             
             # Finally, assign these outside values to the original array
-            self.psi_on_grid[out_mask] = psi_out
+            self.psi_on_grid[out_mask] = _extrapolate_outside(self.psi_interp,Zn,Rn,dZ,dR)
     
             #B on grid
             self.BR_on_grid = self.BR_interp(Z2D,R2D)
-            BR_n = self.BR_interp(Zn,Rn)
-            gradBR_Z, gradBR_R = self.BR_interp.gradient(Zn,Rn)
-            BR_out = BR_n + (Zout-Zn)*gradBR_Z + (Rout-Rn)*gradBR_R
-            self.BR_on_grid[out_mask] = BR_out
+            self.BR_on_grid[out_mask] = _extrapolate_outside(self.BR_interp,Zn,Rn,dZ,dR)
             
             self.BZ_on_grid = self.BZ_interp(Z2D,R2D)
-            BZ_n = self.BZ_interp(Zn,Rn)
-            gradBZ_Z, gradBZ_R = self.BZ_interp.gradient(Zn,Rn)
-            BZ_out = BZ_n + (Zout-Zn)*gradBZ_Z + (Rout-Rn)*gradBZ_R
-            self.BZ_on_grid[out_mask] = BZ_out
+            self.BZ_on_grid[out_mask] = _extrapolate_outside(self.BZ_interp,Zn,Rn,dZ,dR)
             
             self.BPhi_on_grid = self.BPhi_interp(Z2D,R2D)
-            BPhi_n = self.BPhi_interp(Zn,Rn)
-            gradBPhi_Z, gradBPhi_R = self.BPhi_interp.gradient(Zn,Rn)
-            BPhi_out = BPhi_n + (Zout-Zn)*gradBPhi_Z + (Rout-Rn)*gradBPhi_R
-            self.BPhi_on_grid[out_mask] = BPhi_out
+            self.BPhi_on_grid[out_mask] = _extrapolate_outside(self.BPhi_interp,Zn,Rn,dZ,dR)
             
             self.B_on_grid = np.sqrt(self.BR_on_grid**2 + self.BZ_on_grid**2 + self.BPhi_on_grid**2)
                     
@@ -1219,68 +1346,59 @@ class XGC_Loader():
         #ne fluctuations on 3D grid
         
         if(not self.Equilibrium_Only):
-            self.dne_ad_on_grid = np.zeros((self.n_cross_section,len(self.time_steps),r3D.shape[0],r3D.shape[1],r3D.shape[2]))
+            self.dne_ad_on_grid = np.zeros((self.n_cross_section,len(self.time_steps),r3D.shape[0],r3D.shape[1],r3D.shape[2]),dtype = self.fluc_dtype)
             if self.HaveElectron:
-                self.nane_on_grid = np.zeros(self.dne_ad_on_grid.shape)
+                self.nane_on_grid = np.zeros_like(self.dne_ad_on_grid)
             if self.load_ions:
-                self.dni_on_grid = np.zeros(self.dni_ad_on_grid.shape)
+                self.dni_on_grid = np.zeros_like(self.dne_ad_on_grid)
           
-            interp_positions = find_interp_positions_v2_upgrade(self)
+            interp_positions = find_interp_positions_v2_upgrade(self,dtype = self.tracer_dtype)
+
+            #create boolean masks, for each plane the grid points where the plane is used as previous or next plane, and the contiguous (N,2) array of (Z,R) positions to interpolate on that plane. They depend only on the grid, so they are created once for all cross-sections and time steps.
+            prev_mask = []
+            next_mask = []
+            prev_points = []
+            next_points = []
+            for j in range(len(self.planes)):
+                prev_mask.append(self.prevplane == self.planes[j])
+                next_mask.append(self.nextplane == self.planes[j])
+                prev_points.append(np.column_stack((interp_positions[0,0][prev_mask[j]], interp_positions[0,1][prev_mask[j]])))
+                next_points.append(np.column_stack((interp_positions[1,0][next_mask[j]], interp_positions[1,1][next_mask[j]])))
     
-            for k in range(self.n_cross_section):
-                print('center plane {0}.'.format(self.center_planes[k]))
-                for i in range(len(self.time_steps)):
-                    print('time step {0}'.format(self.time_steps[i]))
-                    #for each time step, first create the 2 arrays of quantities for interpolation
-                    prev = np.zeros( (self.grid.NZ,self.grid.NY,self.grid.NX) )
-                    next = np.zeros(prev.shape)
-
-                    #create index dictionary, for each key as plane number and value the corresponding indices where the plane is used as previous or next plane.
-                    prev_idx = {}
-                    next_idx = {}
-                    for j in range(len(self.planes)):
-                        prev_idx[j] = np.where(self.prevplane == self.planes[j] )
-                        next_idx[j] = np.where(self.nextplane == self.planes[j] )
-    
-                    #now interpolate adiabatic ne on each toroidal plane for the points using it as previous or next plane.
-                    for j in range(len(self.planes)):
-                        if(prev[prev_idx[j]].size != 0):
-                            prev[prev_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.dne_ad[k,i,j,:], fill_value = 0)(np.array([interp_positions[0,0][prev_idx[j]], interp_positions[0,1][prev_idx[j]] ]).T )
-                        if(next[next_idx[j]].size != 0):
-                            next[next_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.dne_ad[k,i,j,:], fill_value = 0)(np.array([interp_positions[1,0][next_idx[j]], interp_positions[1,1][next_idx[j]] ]).T )
-                    # on_grid adiabatic ne is then calculated by linearly interpolating values between these two planes
-                
-                    self.dne_ad_on_grid[k,i,...] = prev * interp_positions[1,2,...] + next * interp_positions[0,2,...]
-
-    
-                    if self.HaveElectron:
-                        #non-adiabatic ne data as well:
-                        for j in range(len(self.planes)):
-                            if(prev[prev_idx[j]].size != 0):
-                                prev[prev_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.nane[k,i,j,:], fill_value = 0)(np.array([interp_positions[0,0][prev_idx[j]], interp_positions[0,1][prev_idx[j]] ]).T )
-                            if(next[next_idx[j]].size != 0):
-                                next[next_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.nane[k,i,j,:], fill_value = 0)(np.array([interp_positions[1,0][next_idx[j]], interp_positions[1,1][next_idx[j]] ]).T )
-                        self.nane_on_grid[k,i,...] = prev * interp_positions[1,2,...] + next * interp_positions[0,2,...]
-                        
-                    """   NOW WE WORK WITH IONS   """
-                        
-                    if self.load_ions:
-                        #for each time step, first create the 2 arrays of quantities for interpolation
-                        prev = np.zeros( (self.grid.NZ,self.grid.NY,self.grid.NX) )
-                        next = np.zeros(prev.shape)
-  
-                        for j in range(len(self.planes)):
-                            if(prev[prev_idx[j]].size != 0):
-                                prev[prev_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.dni[k,i,j,:], fill_value = 0)(np.array([interp_positions[0,0][prev_idx[j]], interp_positions[0,1][prev_idx[j]] ]).T )
-                            if(next[next_idx[j]].size != 0):
-                                next[next_idx[j]] = CloughTocher2DInterpolator(self.Delaunay,self.dni[k,i,j,:], fill_value = 0)(np.array([interp_positions[1,0][next_idx[j]], interp_positions[1,1][next_idx[j]] ]).T )                           
-                        self.dni_on_grid[k,i,...] = prev * interp_positions[1,2,...] + next * interp_positions[0,2,...]
+            #the fields to interpolate, and where to store the results
+            fields = [self.dne_ad]
+            fields_on_grid = [self.dne_ad_on_grid]
+            if self.HaveElectron:
+                fields.append(self.nane)
+                fields_on_grid.append(self.nane_on_grid)
+            if self.load_ions:
+                fields.append(self.dni)
+                fields_on_grid.append(self.dni_on_grid)
+
+            #linear interpolation weights of the previous and next planes, taken at the points using each plane
+            prev_weight = [interp_positions[1,2][m] for m in prev_mask]
+            next_weight = [interp_positions[0,2][m] for m in next_mask]
+
+            #now interpolate on each toroidal plane for the points using it as previous or next plane. The data of all fields, cross-sections and time steps on one plane are interpolated by a single CloughTocher2DInterpolator with stacked values, and the previous and next plane points are evaluated together, so the triangulation is searched only once per plane. Planes are independent, so they can be sent to different processes.
+            used_planes = [j for j in range(len(self.planes)) if prev_mask[j].any() or next_mask[j].any()]
+            # values have shape (n_mesh, n_fields, n_cross_section, nt)
+            tasks = ((self.Delaunay,np.moveaxis(np.array([f[:,:,j,:] for f in fields]),-1,0),np.concatenate((prev_points[j],next_points[j]))) for j in used_planes)
+            print('interpolating on planes {0}.'.format(self.planes[used_planes]))
+            # tasks are generated lazily, so only the planes being interpolated have their stacked values in memory
+            results = _imap(_clough_tocher_on_grid,tasks,self.multiprocessing and len(used_planes) > 1)
+            # on_grid quantities are linearly interpolated between the previous and next planes. Each point gets one contribution from its previous plane and one from its next plane, they are added straight into the on_grid arrays as soon as a plane is done, so no full-size buffers are needed.
+            for j,interp_values in zip(used_planes,results):
+                n_prev = len(prev_points[j])
+                for n,f_on_grid in enumerate(fields_on_grid):
+                    f_on_grid[...,prev_mask[j]] += np.moveaxis(interp_values[:n_prev,n],0,-1) * prev_weight[j]
+                    f_on_grid[...,next_mask[j]] += np.moveaxis(interp_values[n_prev:,n],0,-1) * next_weight[j]
 
 
     def interp_check(self, tol = 0.2, toroidal_cross = 0, time = 0):
         """check if the interpolation has been carried out correctly
 
         use the on_grid data to interpolate onto original data locations, and compare the result with the original data, if the relative difference is larger than the tolerance, report the locations and the error.
+        On a uniform grid, the back interpolation uses cubic B-splines with mirror boundary conditions, which differ from the FITPACK splines used before mainly within a few grid cells from the grid edges. The reported errors and violation counts for mesh points near the edges may therefore change slightly. See _back_interpolator.
 
         arguments:
             tol: double, the maximum tolerable error(relative to the original value). Default to be 20 percent.
@@ -1322,29 +1440,32 @@ class XGC_Loader():
         dne_ad_in = self.dne_ad[toroidal_cross,time,idx]
         nane_in = self.nane[toroidal_cross,time,idx]
 
-        dne_ad_back_interp = RectBivariateSpline(self.grid.Z1D,self.grid.R1D,self.dne_ad_on_grid[toroidal_cross,time,:,:])
-        nane_back_interp = RectBivariateSpline(self.grid.Z1D,self.grid.R1D,self.nane_on_grid[toroidal_cross,time,:,:])
+        #the back interpolators are created only once for each cross-section and time step, and reused in later checks until the interpolation is done again. See _back_interpolator for the boundary treatment near the grid edges.
+        key = (toroidal_cross,time)
+        if key not in self._check_splines:
+            self._check_splines[key] = (_back_interpolator(self.grid.Z1D,self.grid.R1D,self.dne_ad_on_grid[toroidal_cross,time,:,:]),
+                                        _back_interpolator(self.grid.Z1D,self.grid.R1D,self.nane_on_grid[toroidal_cross,time,:,:]))
+        dne_ad_back_interp,nane_back_interp = self._check_splines[key]
 
         #compare the points
-        dne_ad_interp = dne_ad_back_interp.ev(Z_in,R_in)
+        dne_ad_interp = dne_ad_back_interp(Z_in,R_in)
         dne_ad_error = np.abs( (dne_ad_in - dne_ad_interp) / dne_ad_interp )
 
-        nane_interp = nane_back_interp.ev(Z_in,R_in)
+        nane_interp = nane_back_interp(Z_in,R_in)
         nane_error = np.abs( (nane_in - nane_interp) / nane_interp )
         
-        #check if the error is within tolerance
-        dne_ad_exceed_tol_idx = np.where(dne_ad_error > tol)
-        nane_exceed_tol_idx = np.where(nane_error > tol)
-
+        #check if the error is within tolerance.
         #Sometimes, tolerance is exceeded because the original data is too small. Check for these cases, an warning is raised only if the original data is greater than 1e-2 * the max value in original data.
-
-        dne_ad_true_violate_idx = np.where(np.abs(dne_ad_in[dne_ad_exceed_tol_idx]) > np.max(np.abs(dne_ad_in))*1e-2 )
-        nane_true_violate_idx = np.where(np.abs(nane_in[nane_exceed_tol_idx]) > np.max(np.abs(nane_in))*1e-2 )
+        #Both conditions are combined into one boolean mask of the violating points in the *_in arrays
+        abs_dne_ad_in = np.abs(dne_ad_in)
+        ad_vio = (dne_ad_error > tol) & (abs_dne_ad_in > np.max(abs_dne_ad_in)*1e-2)
+        abs_nane_in = np.abs(nane_in)
+        na_vio = (nane_error > tol) & (abs_nane_in > np.max(abs_nane_in)*1e-2)
 
         #report the violation locations
         check_pass = True
-        ad_vio_count = len(dne_ad_in[dne_ad_exceed_tol_idx][dne_ad_true_violate_idx])
-        na_vio_count = len(nane_in[nane_exceed_tol_idx][nane_true_violate_idx])
+        ad_vio_count = np.count_nonzero(ad_vio)
+        na_vio_count = np.count_nonzero(na_vio)
         if(ad_vio_count != 0):
             check_pass = False
             print("Warning: adiabatic electron density interpolation inaccurate! {0} points violated. Check the  returned value of method interp_check for detailed information.".format(ad_vio_count))
@@ -1354,8 +1475,8 @@ class XGC_Loader():
         
         #return the tuple containing all information
 
-        adiabatic_error_info = (R_in[dne_ad_exceed_tol_idx][dne_ad_true_violate_idx],Z_in[dne_ad_exceed_tol_idx][dne_ad_true_violate_idx],dne_ad_in[dne_ad_exceed_tol_idx][dne_ad_true_violate_idx],dne_ad_interp[dne_ad_exceed_tol_idx][dne_ad_true_violate_idx],dne_ad_error[dne_ad_exceed_tol_idx][dne_ad_true_violate_idx])
-        non_adiabatic_error_info = (R_in[nane_exceed_tol_idx][nane_true_violate_idx],Z_in[nane_exceed_tol_idx][nane_true_violate_idx],nane_in[nane_exceed_tol_idx][nane_true_violate_idx],nane_interp[nane_exceed_tol_idx][nane_true_violate_idx],nane_error[nane_exceed_tol_idx][nane_true_violate_idx])
+        adiabatic_error_info = (R_in[ad_vio],Z_in[ad_vio],dne_ad_in[ad_vio],dne_ad_interp[ad_vio],dne_ad_error[ad_vio])
+        non_adiabatic_error_info = (R_in[na_vio],Z_in[na_vio],nane_in[na_vio],nane_interp[na_vio],nane_error[na_vio])
 
         return (check_pass,adiabatic_error_info,non_adiabatic_error_info)
             
@@ -1446,35 +1567,40 @@ class XGC_Loader():
         #======== NEED MORE DETAILED GEOMETRY CHECKING HERE! CURRENT VERSION DOESN'T GUARANTEE SAME GRID. ERRORS WILL OCCUR WHEN READ SAVED FILE WITH A DIFFERENT GRID.
         #=============================================#
 
-        self.mesh = {'R':np.copy(nefile['X_origin']),'Z':np.copy(nefile['Y_origin'])}
-        self.dne_ad = np.copy(nefile['dne_ad_org'])
-        self.ne0_on_grid = np.copy(nefile['ne0'])
-        self.dne_ad_on_grid = np.copy(nefile['dne_ad'])
+        #each item read from the npz file is a new array owned by the caller, so no copies are needed
+        self.mesh = {'R':nefile['X_origin'],'Z':nefile['Y_origin']}
+        self.dne_ad = nefile['dne_ad_org']
+        self.ne0_on_grid = nefile['ne0']
+        self.dne_ad_on_grid = nefile['dne_ad']
+        #on grid data is replaced, splines cached by interp_check are not valid anymore
+        self._check_splines = {}
 
         self.ne_on_grid = self.ne0_on_grid[np.newaxis,np.newaxis,:,:] + self.dne_ad_on_grid
 
         if 'nane' in nefile.files:
             self.HaveElectrons = True
-            self.nane = np.copy(nefile['nane_org'])
+            self.nane = nefile['nane_org']
             self.nane_on_grid = nefile['nane']
             self.ne_on_grid += self.nane_on_grid
 
-        self.psi_on_grid = np.copy(nefile['psi'])
-        self.te_on_grid = np.copy(nefile['Te0'])
-        self.ti_on_grid = np.copy(nefile['Ti0'])
+        self.psi_on_grid = nefile['psi']
+        self.te_on_grid = nefile['Te0']
+        self.ti_on_grid = nefile['Ti0']
 
         if dimension == 2:
-            self.B_on_grid = np.copy(nefile['B0'])
+            self.B_on_grid = nefile['B0']
         elif equilibrium_mesh == '3D':
-            self.BZ_on_grid = np.copy(nefile['B0'])
-            self.BX_on_grid = np.copy(nefile['BX'])
-            self.BY_on_grid = np.copy(nefile['BY'])
-            self.B_on_grid = np.sqrt(self.BX_on_grid**2 + self.BY_on_grid**2 + self.BZ_on_grid**2) 
+            self.BZ_on_grid = nefile['B0']
+            self.BX_on_grid = nefile['BX']
+            self.BY_on_grid = nefile['BY']
+            self.B_on_grid = np.sqrt(_sum_of_squares(self.BX_on_grid,self.BY_on_grid,self.BZ_on_grid))
         elif equilibrium_mesh == '2D':
-            self.BPhi_on_grid = np.copy(nefile['B0'])
-            self.BR_on_grid = np.copy(nefile['BR'])
-            self.BZ_on_grid = np.copy(nefile['BZ'])
-            self.B_on_grid = np.sqrt(self.BPhi_on_grid**2 + self.BR_on_grid**2 + self.BZ_on_grid**2)
+            self.BPhi_on_grid = nefile['B0']
+            self.BR_on_grid = nefile['BR']
+            self.BZ_on_grid = nefile['BZ']
+            self.B_on_grid = np.sqrt(_sum_of_squares(self.BPhi_on_grid,self.BR_on_grid,self.BZ_on_grid))
+
+        nefile.close()
 
     def cdf_output(self,output_path,eq_file = 'equilibrium.cdf',filehead = 'fluctuation',WithBp=True):
         """
@@ -1513,6 +1639,9 @@ class XGC_Loader():
         
         """
         file_start = output_path + filehead
+        #equilibrium temperatures are the same in all files, convert them to keV only once
+        te_keV = self.te_on_grid/1000
+        ti_keV = self.ti_on_grid/1000
         for i in range(self.n_cross_section):
             for j in range(len(self.time_steps)):
             
@@ -1531,20 +1660,22 @@ class XGC_Loader():
                 bb[:,:] = self.B_on_grid[:,:]
                 bb.units = 'Tesla'
                 
-                dne = f.createVariable('dne','d',('z_dim','r_dim'))                
-                dne[:,:] = self.dne_ad_on_grid[i,j,:,:] + self.nane_on_grid[i,j,:,:]
+                #total perturbation is summed in memory, and used for ne without reading back the netcdf variable
+                dne_sum = self.dne_ad_on_grid[i,j,:,:] + self.nane_on_grid[i,j,:,:]
+                dne = f.createVariable('dne',dne_sum.dtype.char,('z_dim','r_dim'))                
+                dne[:,:] = dne_sum
                 dne.units = 'per cubic meter'
                 
                 ne = f.createVariable('ne','d',('z_dim','r_dim'))
-                ne[:,:] = self.ne0_on_grid[:,:] + dne[:,:]
+                ne[:,:] = self.ne0_on_grid[:,:] + dne_sum
                 ne.units = 'per cubic meter'
 
                 te = f.createVariable('te','d',('z_dim','r_dim'))
-                te[:,:] = self.te_on_grid[:,:]/1000
+                te[:,:] = te_keV
                 te.units = 'keV'
                 
                 ti = f.createVariable('ti','d',('z_dim','r_dim'))
-                ti[:,:] = self.ti_on_grid[:,:]/1000
+                ti[:,:] = ti_keV
                 ti.units = 'keV'
 
                 f.close()
@@ -1598,10 +1729,12 @@ class XGC_Loader():
         zz[:] = self.grid.Y1D[:]
         rr.units = zz.units = 'm'
 
-        bp = np.sqrt(self.BX_on_grid[:,:]**2 + self.BY_on_grid[:,:]**2)
+        #the squared poloidal field is shared by the total and the poloidal field magnitudes
+        bp2 = _sum_of_squares(self.BX_on_grid,self.BY_on_grid)
         
         bb = f.createVariable('bb','d',('nz','nr'))
-        bb[:,:] = np.sqrt(bp**2 + self.BZ_on_grid[:,:]**2)
+        bb[:,:] = np.sqrt(bp2 + np.square(self.BZ_on_grid))
+        bp = np.sqrt(bp2,out = bp2)
         bb.units = 'Tesla'
 
         bpol = f.createVariable('bpol','d',('nz','nr'))
@@ -1640,29 +1773,19 @@ class XGC_Loader():
 
         if(not self.Equilibrium_Only):
             file_start = output_path + flucfilehead
-            for j in range(self.n_cross_section):
-                for i in range(len(self.time_steps)):
-                    fname = file_start + str(self.time_steps[i]) +'_'+ str(j)+ '.cdf'
-                    f = nc.netcdf_file(fname,'w')
-                    f.createDimension('nx',self.grid.NX)
-                    f.createDimension('ny',self.grid.NY)
-                    f.createDimension('nz',self.grid.NZ)
-    
-                    xx = f.createVariable('xx','d',('nx',))
-                    xx[:] = self.grid.X1D[:]
-                    yy = f.createVariable('yy','d',('ny',))
-                    yy[:] = self.grid.Y1D[:]
-                    zz = f.createVariable('zz','d',('nz',))
-                    zz[:] = self.grid.Z1D[:]            
-                    xx.units = yy.units = zz.units = 'm'
-                
-                    dne = f.createVariable('dne','d',('nz','ny','nx'))
-                    dne.units = 'm^-3'
-                    if(not self.HaveElectron):
-                        dne[:,:,:] = self.dne_ad_on_grid[j,i,:,:,:]*self.dn_amplifier          
-                    else:
-                        dne[:,:,:] = (self.dne_ad_on_grid[j,i,:,:,:] + self.nane_on_grid[j,i,:,:,:])*self.dn_amplifier
-                    f.close()
+            # fluctuation files are independent of each other, so they can be written by different processes. Tasks are generated one by one, so that the serial writing does not hold all the perturbations in memory.
+            def tasks():
+                for j in range(self.n_cross_section):
+                    for i in range(len(self.time_steps)):
+                        fname = file_start + str(self.time_steps[i]) +'_'+ str(j)+ '.cdf'
+                        if(not self.HaveElectron):
+                            dne = self.dne_ad_on_grid[j,i,:,:,:]*self.dn_amplifier          
+                        else:
+                            dne = (self.dne_ad_on_grid[j,i,:,:,:] + self.nane_on_grid[j,i,:,:,:])*self.dn_amplifier
+                        yield (fname,self.grid.X1D,self.grid.Y1D,self.grid.Z1D,dne)
+            # each task carries a whole 3D perturbation, so they are sent one at a time (chunksize 1) and in any order, only the files being written have their perturbation in memory
+            for _ in _imap(_write_fluc_cdf_3D,tasks(),self.multiprocessing and self.n_cross_section*len(self.time_steps) > 1,ordered = False,chunksize = 1):
+                pass
     
         
 
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+test the correlation functions in sdp.diagnostic.fwr.fwr2d.postprocess
+"""
+import numpy as np
+
+import sdp.diagnostic.fwr.fwr2d.postprocess as pp
+
+
+class _Output(object):
+    """minimal stand-in of Reflectometer_Output, carrying only the received
+    signals"""
+
+    def __init__(self, E_out):
+        self.E_out = E_out
+        self.NF, self.NT, self.n_cross_section = E_out.shape
+
+
+def _cross_correlation_ref(E_out):
+    """the original pair by pair <M(w0)M*(w1)>/sqrt(<|M(w0)|^2><|M(w1)|^2>)"""
+    NF = E_out.shape[0]
+    M2_bar = np.average(np.average(E_out*np.conj(E_out), axis=2), axis=1)
+    r = np.zeros((NF, NF), dtype=complex)
+    for f0 in range(NF):
+        for f1 in range(NF):
+            cross_bar = np.average(E_out[f0]*np.conj(E_out[f1]))
+            r[f0, f1] = cross_bar/np.sqrt(M2_bar[f0]*M2_bar[f1])
+    return r
+
+
+def _cross_correlation_by_fft_ref(E_out):
+    """the original pair by pair zero delay ifft(conj(F_i)*F_j)[0], with F
+    normalized by sqrt(<|F|^2>)"""
+    NF = E_out.shape[0]
+    F = np.fft.fft(E_out.reshape((NF, -1)), axis=1)
+    F_norm = np.sqrt(np.average(np.conj(F)*F, axis=1))
+    r = np.zeros((NF, NF), dtype=complex)
+    for i in range(NF):
+        for j in range(NF):
+            gamma_f = np.conj(F[i])*F[j]/(F_norm[i]*F_norm[j])
+            r[i, j] = np.fft.ifft(gamma_f)[0]
+    return r
+
+
+def test_cross_correlation():
+    rng = np.random.RandomState(4)
+    NF, NT, n_cross = 5, 23, 3
+    # correlated channels, so that the off-diagonal terms are not small
+    common = rng.normal(size=(NT, n_cross)) + 1j*rng.normal(size=(NT, n_cross))
+    E_out = (rng.normal(size=(NF, NT, n_cross))
+             + 1j*rng.normal(size=(NF, NT, n_cross)) + 2*common)
+    output = _Output(E_out)
+    r_ref = _cross_correlation_ref(E_out)
+    r_fft_ref = _cross_correlation_by_fft_ref(E_out)
+
+    defaults = pp._correlation_sums.__defaults__
+    try:
+        # block sizes that split the NT*n_cross=69 samples evenly, unevenly,
+        # and not at all
+        for block_size in [1, 7, 23, 69, 1000]:
+            pp._correlation_sums.__defaults__ = (block_size,)
+            r = pp.Cross_Correlation(output)
+            r_fft = pp.Cross_Correlation_by_fft(output)
+            assert np.allclose(r, r_ref, rtol=1e-12, atol=1e-12), block_size
+            assert np.allclose(r_fft, r_fft_ref, rtol=1e-12, atol=1e-12),\
+                block_size
+            # the off-diagonal part is exactly Hermitian
+            off = ~np.eye(NF, dtype=bool)
+            assert np.array_equal(r[off], r.T.conj()[off]), block_size
+            assert np.array_equal(r_fft[off], r_fft.T.conj()[off]), block_size
+    finally:
+        pp._correlation_sums.__defaults__ = defaults
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+test sdp.plasma.xgc.loader helper functions
+"""
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import h5py as h5
+
+import sdp.plasma.xgc.loader as loader
+from sdp.math.rungekutta import runge_kutta_explicit
+
+
+class _Grid(object):
+    pass
+
+
+class _XGC(object):
+    """minimal stand-in of XGC_Loader, carrying only the plane information
+    used by get_interp_planes"""
+
+    def __init__(self, n_plane, phi3D, CO_DIR=True):
+        self.n_plane = n_plane
+        self.dPHI = 2*np.pi/n_plane
+        self.phi_planes = np.arange(n_plane)*self.dPHI
+        self.CO_DIR = CO_DIR
+        self.grid = _Grid()
+        self.grid.phi3D = phi3D
+
+
+def _phi_samples(phi_planes):
+    """phi values on each plane, one ulp on either side of each plane,
+    random values in between, and values outside [0, 2pi)"""
+    on_plane = np.concatenate((phi_planes, [2*np.pi]))
+    below = np.nextafter(on_plane, -np.inf)
+    above = np.nextafter(on_plane, np.inf)
+    rng = np.random.RandomState(0)
+    inside = rng.uniform(0, 2*np.pi, 1000)
+    outside = np.array([-1.0, -1e-300, 2*np.pi+1e-9, 7.0, 100.0])
+    return np.concatenate((on_plane, below, above, inside, outside))
+
+
+def test_get_interp_planes():
+    for n_plane in [1, 2, 3, 7, 8, 16, 32, 64]:
+        for CO_DIR in [True, False]:
+            phi_planes = np.arange(n_plane)*2*np.pi/n_plane
+            phi3D = _phi_samples(phi_planes).reshape(1, 1, -1)
+            xgc = _XGC(n_plane, phi3D, CO_DIR)
+
+            prevplane, nextplane = loader.get_interp_planes(xgc)
+
+            n_before = np.searchsorted(phi_planes, phi3D, side='right')
+            if CO_DIR:
+                next_ref = n_before.copy()
+                prev_ref = next_ref - 1
+                next_ref[next_ref == n_plane] = 0
+            else:
+                prev_ref = n_before.copy()
+                next_ref = prev_ref - 1
+                prev_ref[prev_ref == n_plane] = 0
+            assert np.array_equal(prevplane, prev_ref), (n_plane, CO_DIR)
+            assert np.array_equal(nextplane, next_ref), (n_plane, CO_DIR)
+
+
+def _check_deflate_read(dataset, out_dtype):
+    """compare _read_deflate_chunks with Dataset.read_direct into the same 
+    target dtype"""
+    ref = np.empty(dataset.shape, dtype=out_dtype)
+    dataset.read_direct(ref)
+    out = np.empty(dataset.shape, dtype=out_dtype)
+    assert loader._read_deflate_chunks(dataset, out), dataset.name
+    assert np.array_equal(out, ref), dataset.name
+
+
+def test_read_deflate_chunks():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        fname = os.path.join(tmpdir, 'deflate.h5')
+        rng = np.random.RandomState(1)
+        data = rng.normal(size=(37, 11))
+        with h5.File(fname, 'w') as f:
+            # edge chunks in both dimensions
+            f.create_dataset('edge', data=data, chunks=(8, 4), 
+                             compression='gzip')
+            # the whole dataset in a single chunk
+            f.create_dataset('single', data=data, chunks=data.shape, 
+                             compression='gzip')
+            f.create_dataset('big_endian', data=data.astype('>f8'), 
+                             chunks=(10, 5), compression='gzip')
+            f.create_dataset('float32', data=data.astype(np.float32), 
+                             chunks=(16, 11), compression='gzip')
+            f.create_dataset('one_d', data=data[:, 0], chunks=(5,), 
+                             compression='gzip')
+            # one chunk stored with the deflate filter skipped
+            d = f.create_dataset('skipped', data=data, chunks=(8, 11), 
+                                 compression='gzip')
+            d.id.write_direct_chunk((8, 0), 
+                                    np.ascontiguousarray(data[8:16]+1).tobytes(),
+                                    filter_mask=1)
+            # not handled, should be left to the normal reading
+            f.create_dataset('contiguous', data=data)
+            f.create_dataset('shuffled', data=data, chunks=(8, 4), 
+                             compression='gzip', shuffle=True)
+
+        with h5.File(fname, 'r') as f:
+            for name in ['edge', 'single', 'big_endian', 'float32', 'one_d',
+                         'skipped']:
+                for out_dtype in [np.float64, np.float32]:
+                    _check_deflate_read(f[name], out_dtype)
+            assert np.array_equal(f['skipped'][8:16], data[8:16]+1)
+            for name in ['contiguous', 'shuffled']:
+                out = np.empty(f[name].shape)
+                assert not loader._read_deflate_chunks(f[name], out), name
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def _B_field(Z, R):
+    """analytic (BR, BZ, BPhi) on a circular "mesh" of radius 0.4 around 
+    (R,Z)=(1.5,0), masked outside as the triangular interpolators do. Field
+    lines spiral outwards, so the ones starting near the edge leave the mesh.
+    """
+    outside = (R-1.5)**2 + Z**2 > 0.16
+    return [np.ma.masked_array(B, mask=outside) for B in 
+            (0.3*Z + 0.5*(R-1.5), -0.3*(R-1.5) + 0.5*Z, 2.0/R)]
+
+
+def _reference_trace(R, Z, phi, dphi):
+    """plain point by point RK2 (midpoint) field line tracing, steps of dphi
+    until the remaining angle is not larger than dphi"""
+    a, b, c, Nstage = runge_kutta_explicit(2)
+
+    def derivatives(R, Z):
+        BR, BZ, BPhi = _B_field(np.array([Z]), np.array([R]))
+        if np.ma.getmaskarray(BPhi)[0]:
+            bR = bZ = 0.
+        else:
+            bR = BR.data[0]/BPhi.data[0]
+            bZ = BZ.data[0]/BPhi.data[0]
+        return R*bR, R*bZ, np.sqrt(1.0 + bR**2 + bZ**2)*R
+
+    s = 0.
+    left = phi
+    while left != 0:
+        step = left if abs(left) <= abs(dphi) else dphi
+        left -= step
+        K0 = derivatives(R, Z)
+        K1 = derivatives(R+step*a[1, 0]*K0[0], Z+step*a[1, 0]*K0[1])
+        s += abs(step)*(b[0]*K0[2] + b[1]*K1[2])
+        Z += step*(b[0]*K0[1] + b[1]*K1[1])
+        R += step*(b[0]*K0[0] + b[1]*K1[0])
+    return R, Z, s
+
+
+def test_trace_field_line():
+    rng = np.random.RandomState(2)
+    n = 50
+    dphi = 2*np.pi/8/10
+    # starting points inside, near the edge, and outside of the mesh, so 
+    # that some field lines leave the mesh or never enter it
+    R0 = rng.uniform(1.05, 1.95, n)
+    Z0 = rng.uniform(-0.45, 0.45, n)
+    phi0 = rng.uniform(0, 10*dphi, n)
+    # no tracing at all, and angles of exactly a whole number of steps
+    phi0[:3] = [0., dphi, 4*dphi]
+    for sign in [1, -1]:
+        results = []
+        for chunk_size in [7, 32768]:
+            R, Z, s = R0.copy(), Z0.copy(), np.zeros(n)
+            phi = sign*phi0
+            loader._trace_field_line(_B_field, R, Z, s, phi, sign*dphi, 
+                                     'test', chunk_size=chunk_size)
+            assert np.all(phi == 0)
+            results.append((R, Z, s))
+        # chunking must not change anything
+        for x, y in zip(results[0], results[1]):
+            assert np.array_equal(x, y)
+        R, Z, s = results[0]
+        for i in range(n):
+            R_ref, Z_ref, s_ref = _reference_trace(R0[i], Z0[i], sign*phi0[i],
+                                                   sign*dphi)
+            assert np.array_equal([R[i], Z[i], s[i]], [R_ref, Z_ref, s_ref]),\
+                (sign, i)
+
+
+def test_back_interpolator():
+    from scipy.interpolate import RectBivariateSpline
+    rng = np.random.RandomState(3)
+    Z1D = np.linspace(-0.5, 0.5, 41)
+    R1D = np.linspace(1.2, 2.0, 33)
+    R2D, Z2D = np.meshgrid(R1D, Z1D)
+    data = np.sin(3*R2D)*np.cos(4*Z2D) + 0.1*R2D*Z2D
+    spline = RectBivariateSpline(Z1D, R1D, data)
+    # uniform grid: the boundary conditions differ, but the difference to the
+    # FITPACK spline decays quickly away from the edges
+    interp = loader._back_interpolator(Z1D, R1D, data)
+    dZ, dR = Z1D[1]-Z1D[0], R1D[1]-R1D[0]
+    Z = rng.uniform(Z1D[0]+6*dZ, Z1D[-1]-6*dZ, 1000)
+    R = rng.uniform(R1D[0]+6*dR, R1D[-1]-6*dR, 1000)
+    assert np.allclose(interp(Z, R), spline(Z, R, grid=False), rtol=0, 
+                       atol=1e-4*np.max(np.abs(data)))
+    # both are interpolating, on the grid points they return the data
+    assert np.allclose(interp(Z2D.ravel(), R2D.ravel()), data.ravel())
+    # non-uniform grid: falls back to RectBivariateSpline
+    R1D_nu = R1D[0] + (R1D-R1D[0])**2/(R1D[-1]-R1D[0])
+    interp = loader._back_interpolator(Z1D, R1D_nu, data)
+    spline = RectBivariateSpline(Z1D, R1D_nu, data)
+    assert np.array_equal(interp(Z, R), spline(Z, R, grid=False))